@@ -1,12 +1,13 @@
 # anime2d/cli.py
 from __future__ import annotations
 from pathlib import Path
+from typing import List
 import typer
 import json, shutil, subprocess
 
 from anime2d import __version__, banner
 from anime2d.utils.paths import ensure_dirs, get_paths, write_gitignore
-from anime2d.utils.config import save_default_config
+from anime2d.utils.config import load_config, save_default_config
 
 app = typer.Typer(add_completion=False, help="anime2d: prompt→Live2D-style anime puppet (local/FOSS)")
 
@@ -41,28 +42,88 @@ def art(
     ref: Path = typer.Option(None, help="Optional front-view reference image."),
     cfg: Path = typer.Option(Path("configs/default.yaml"), help="Config file to use."),
     strength: float = typer.Option(0.55, min=0.1, max=0.95, help="How much to deviate from reference"),
+    scheduler: str = typer.Option(None, help="Sampler (dpmpp_2m, dpmpp_2m_karras, unipc, euler, euler_a, ddim). Default: sd.scheduler in config."),
+    batch: int = typer.Option(1, min=1, help="Images to generate (seeds seed, seed+1, ...); split into chunks if memory is tight."),
+    profile: bool = typer.Option(False, "--profile", help="Write a Chrome trace + folded stacks for this run to outputs/<date>/profiles/."),
 ):
     """
     Generate a front-view anime portrait/upper body (Diffusers SD1.5).
     """
     from anime2d.generate.art import generate_art
-    out_path = generate_art(prompt=prompt, cfg_path=cfg, ref_image=ref, strength=strength)
+    profiler = None
+    if profile:
+        from anime2d.generate.profiling import JobProfiler, unique_profile_name
+        profiler = JobProfiler(unique_profile_name("art"))
+    out_path = generate_art(prompt=prompt, cfg_path=cfg, ref_image=ref, strength=strength, scheduler=scheduler, batch=batch, profile=profiler or False)
 
     typer.echo(f"Saved: {out_path}")
+    if profiler is not None and profiler.trace_path is not None:
+        typer.echo(f"Profile: {profiler.trace_path}")
+        typer.echo(f"Stacks : {profiler.stacks_path}")
 
 @app.command()
 def split(
-    in_: Path = typer.Option(..., "--in", help="Input art.png from `anime2d art`"),
-    out: Path = typer.Option(..., "--out", help="Output layers.psd"),
+    in_: Path = typer.Option(..., "--in", help="Input art.png from `anime2d art`, or a folder of PNGs"),
+    out: Path = typer.Option(..., "--out", help="Output layers.psd (or output folder when --in is a folder)"),
     no_matte: bool = typer.Option(False, "--no-matte", help="Skip rembg (use original RGBA)"),
+    parts: bool = typer.Option(True, "--parts/--no-parts", help="Fill the scaffold layers with segmented parts"),
+    cfg: Path = typer.Option(Path("configs/default.yaml"), help="Config file to use (split: section)."),
+    workers: int = typer.Option(4, min=1, help="Images processed in parallel when --in is a folder"),
 ):
 
-    from anime2d.split.split import split_to_psd
-    out_psd, matte = split_to_psd(in_png=in_, out_psd=out, save_matte=True, no_matte=no_matte)
+    from anime2d.split.split import split_dir, split_to_psd
+    from anime2d.split.parts import backends_from_config
+    split_cfg = load_config(cfg)["split"]
+    kwargs = dict(no_matte=no_matte, parts=parts, backends=backends_from_config(split_cfg),
+                  post_morphology=bool(split_cfg.get("post_morphology", True)))
+    if in_.is_dir():
+        results = split_dir(in_, out, workers=workers, **kwargs)
+        for out_psd, _ in results:
+            typer.echo(f"PSD : {out_psd}")
+        typer.echo(f"{len(results)} image(s) → {out}")
+        return
+    out_psd, matte = split_to_psd(in_png=in_, out_psd=out, save_matte=True, **kwargs)
     typer.echo(f"PSD : {out_psd}")
     if matte:
         typer.echo(f"Matte: {matte}")
 
+@app.command()
+def pipeline(
+    prompt: List[str] = typer.Option(None, help="Character description; repeat for several characters."),
+    prompts_file: Path = typer.Option(None, help="Text file with one prompt per line (# comments ok)."),
+    cfg: Path = typer.Option(Path("configs/default.yaml"), help="Config file to use."),
+    out: Path = typer.Option(None, help="Output folder (default outputs/<date>/pipeline)."),
+    art_workers: int = typer.Option(None, min=1, help="Art workers (each loads its own SD pipeline). Default: pipeline.workers.art."),
+    upscale_workers: int = typer.Option(None, min=1, help="Upscale workers. Default: pipeline.workers.upscale."),
+    split_workers: int = typer.Option(None, min=1, help="Split workers. Default: pipeline.workers.split."),
+    queue_size: int = typer.Option(None, min=1, help="Items a stage may run ahead of the next. Default: pipeline.queue_size."),
+    no_matte: bool = typer.Option(False, "--no-matte", help="Skip rembg (use original RGBA)"),
+):
+    """
+    art → upscale → split for many prompts, with the stages overlapped so the
+    GPU keeps generating while earlier characters are matted and layered.
+    """
+    from anime2d.pipeline import run_art_pipeline
+    prompts = list(prompt or [])
+    if prompts_file is not None:
+        lines = prompts_file.read_text(encoding="utf-8").splitlines()
+        prompts += [ln.strip() for ln in lines if ln.strip() and not ln.lstrip().startswith("#")]
+    if not prompts:
+        raise typer.BadParameter("give --prompt and/or --prompts-file")
+
+    workers = {k: v for k, v in (("art", art_workers), ("upscale", upscale_workers), ("split", split_workers)) if v}
+    results, stats, wall = run_art_pipeline(prompts, cfg, out_dir=out, workers=workers,
+                                            queue_size=queue_size, no_matte=no_matte)
+    for r in results:
+        typer.echo(f"[{r['index']:03d}] PSD : {r['psd']}")
+    typer.echo(f"{len(results)}/{len(prompts)} done in {wall:.1f}s")
+    for st in stats:
+        typer.echo(f"  {st.name:<8} x{st.workers}  items={st.items} errors={st.errors}  "
+                   f"busy={st.busy_s:.1f}s starved={st.starved_s:.1f}s blocked={st.blocked_s:.1f}s  "
+                   f"util={100 * st.utilisation(wall):.0f}%")
+        for msg in st.error_messages:
+            typer.echo(f"    ! {msg}")
+
 
 def main():
     app()
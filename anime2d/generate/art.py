@@ -1,13 +1,13 @@
 from __future__ import annotations
 from pathlib import Path
-from typing import Optional, Dict, Any
+from typing import TYPE_CHECKING, Optional, Dict, Any
+from contextlib import nullcontext
 import json
 import torch
 from PIL import Image
 from diffusers import (
     StableDiffusionPipeline,
     StableDiffusionControlNetPipeline,
-    DPMSolverMultistepScheduler,
     ControlNetModel,
     StableDiffusionImg2ImgPipeline,
 )
@@ -15,6 +15,10 @@ from controlnet_aux import LineartDetector
 from anime2d.utils.config import load_config
 from anime2d.utils.paths import dated_output_dir, get_paths
 from anime2d.generate.upscale import realesrgan_upscale
+from anime2d.generate.schedulers import DEFAULT_SCHEDULER, build_scheduler
+from anime2d.generate.memory import apply_plan, plan_for_pipe, record_plan, track_peak
+if TYPE_CHECKING:
+    from anime2d.generate.profiling import JobProfiler
 
 def _build_img2img_from_base(base_pipe):
     """Build an img2img pipeline reusing the same components as the base txt2img pipe."""
@@ -24,7 +28,7 @@ def _build_img2img_from_base(base_pipe):
         img2img.to("cuda")
     else:
         img2img.enable_model_cpu_offload()
-    img2img.enable_vae_tiling()
+    # VAE tiling/slicing and attention slicing are set per job by the memory planner
     return img2img
 
 def _maybe_local(model_id: str, fallback_dir: Optional[str] = None) -> tuple[str, bool]:
@@ -40,55 +44,96 @@ def _maybe_local(model_id: str, fallback_dir: Optional[str] = None) -> tuple[str
 def _device() -> str:
     return "cuda" if torch.cuda.is_available() else "cpu"
 
-def _build_base(sd_model_id: str, local: bool) -> StableDiffusionPipeline:
+def _build_base(sd_model_id: str, local: bool, scheduler: str = DEFAULT_SCHEDULER) -> StableDiffusionPipeline:
     pipe = StableDiffusionPipeline.from_pretrained(
         sd_model_id, torch_dtype=torch.float16, safety_checker=None, local_files_only=local
     )
-    pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+    # keep the checkpoint's own scheduler config: other samplers are built from it, not from this one
+    pipe._anime2d_scheduler_config = pipe.scheduler.config
+    pipe.scheduler = build_scheduler(scheduler, pipe.scheduler.config)
     dev = _device()
     if dev == "cuda":
         pipe.to(dev)
     else:
         pipe.enable_model_cpu_offload()
-    pipe.enable_vae_tiling()
+    # VAE tiling/slicing and attention slicing are set per job by the memory planner
     pipe.vae.config.force_upcast = True  # crucial for Windows/torch2.4 black image issues
     return pipe
 
 def _build_controlnet(lineart_model_id: str, local: bool) -> ControlNetModel:
     return ControlNetModel.from_pretrained(lineart_model_id, torch_dtype=torch.float16, local_files_only=local)
 
-def _build_cnet_pipe(sd_model_id: str, sd_local: bool, cnet: ControlNetModel) -> StableDiffusionControlNetPipeline:
+def _build_cnet_pipe(sd_model_id: str, sd_local: bool, cnet: ControlNetModel,
+                     scheduler: str = DEFAULT_SCHEDULER) -> StableDiffusionControlNetPipeline:
     pipe = StableDiffusionControlNetPipeline.from_pretrained(
         sd_model_id, controlnet=cnet, torch_dtype=torch.float16, safety_checker=None, local_files_only=sd_local
     )
-    pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+    # keep the checkpoint's own scheduler config: other samplers are built from it, not from this one
+    pipe._anime2d_scheduler_config = pipe.scheduler.config
+    pipe.scheduler = build_scheduler(scheduler, pipe.scheduler.config)
     dev = _device()
     if dev == "cuda":
         pipe.to(dev)
     else:
         pipe.enable_model_cpu_offload()
-    pipe.enable_vae_tiling()
     pipe.vae.config.force_upcast = True
     return pipe
 
+def build_art_pipe(cfg_path: str | Path | None = None, scheduler: str | None = None) -> StableDiffusionPipeline:
+    """txt2img base pipe for the config's `sd.model` / `sd.scheduler`, for reuse across generate_art calls."""
+    sd = load_config(cfg_path or (get_paths().configs / "default.yaml"))["sd"]
+    sd_model_id, sd_local = _maybe_local(str(sd["model"]), fallback_dir="wd15")
+    return _build_base(sd_model_id, local=sd_local, scheduler=scheduler or sd.get("scheduler") or DEFAULT_SCHEDULER)
+
 def generate_art(prompt: str,
-                 out_path: str,
+                 out_path: str | Path | None = None,
                  *,
-                 ref_image: str | None = None,
+                 cfg_path: str | Path | None = None,
+                 ref_image: str | Path | None = None,
                  strength: float = 0.55,
-                 width: int = 512,
-                 height: int = 768,
-                 steps: int = 24,
-                 guidance: float = 7.0,
-                 negative: str = "",
-                 seed: int | None = 123456,
-                 **kwargs):
-
-    # 1) Build your usual txt2img base pipe (you already have this in _build_base)
-    pipe = _build_base(...)   # <- whatever you already do to load wd15 locally
-    gen  = torch.Generator(device="cuda" if torch.cuda.is_available() else "cpu")
-    if seed is not None:
-        gen = gen.manual_seed(int(seed))
+                 width: int | None = None,
+                 height: int | None = None,
+                 steps: int | None = None,
+                 guidance: float | None = None,
+                 negative: str | None = None,
+                 seed: int | None = None,
+                 scheduler: str | None = None,
+                 batch: int = 1,
+                 profile: bool | JobProfiler = False,
+                 pipe: StableDiffusionPipeline | None = None,
+                 **kwargs) -> Path:
+    """
+    txt2img (or img2img when `ref_image` is given). Unset knobs fall back to the
+    `sd:` section of the config; output defaults to outputs/<date>/art.png.
+    With `batch > 1`, extra images are saved next to it as art_1.png, art_2.png, ...
+    using seeds seed+1, seed+2, ...
+    `profile=True` wraps the denoising calls in torch.profiler + a stack sampler
+    and writes the traces under outputs/<date>/profiles/; pass your own
+    JobProfiler instead to read its trace_path / stacks_path afterwards.
+    Pass a warm `pipe` (from build_art_pipe) to skip loading the model per call.
+    """
+    cfg = load_config(cfg_path or (get_paths().configs / "default.yaml"))
+    sd = cfg["sd"]
+    width    = width    if width    is not None else int(sd["width"])
+    height   = height   if height   is not None else int(sd["height"])
+    steps    = steps    if steps    is not None else int(sd["steps"])
+    guidance = guidance if guidance is not None else float(sd["guidance"])
+    negative = negative if negative is not None else str(sd.get("negative") or "")
+    seed     = seed     if seed     is not None else cfg.get("seed")
+    scheduler = scheduler or sd.get("scheduler") or DEFAULT_SCHEDULER
+
+    if out_path is None:
+        out_dir = dated_output_dir()
+        out_dir.mkdir(parents=True, exist_ok=True)
+        out_path = out_dir / "art.png"
+
+    # 1) Usual txt2img base pipe (prefers models/wd15 when present)
+    if pipe is None:
+        sd_model_id, sd_local = _maybe_local(str(sd["model"]), fallback_dir="wd15")
+        pipe = _build_base(sd_model_id, local=sd_local, scheduler=scheduler)
+    dev  = "cuda" if torch.cuda.is_available() else "cpu"
+    batch = max(1, int(batch))
+    base_seed = int(seed) if seed is not None else int(torch.seed() % (2**31))
 
     # 2) Snap dims to multiples of 64
     def _snap64(x: int) -> int: return max(64, (x // 64) * 64)
@@ -98,29 +143,49 @@ def generate_art(prompt: str,
     if ref_image:
         # Load JPG/PNG; PIL handles both
         init_img = Image.open(ref_image).convert("RGB").resize((W, H), Image.BICUBIC)
-
-        img2img = _build_img2img_from_base(pipe)
-
-        result = img2img(
-            prompt=prompt,
+        run_pipe = _build_img2img_from_base(pipe)
+        call_kw = dict(
             image=init_img,
             strength=float(strength),        # lower = closer to the image (0.2–0.45), higher = more change (0.6–0.8)
-            negative_prompt=negative,
-            num_inference_steps=int(steps),
-            guidance_scale=float(guidance),
-            generator=gen,
         )
     else:
         # Pure TXT2IMG
-        result = pipe(
-            prompt=prompt,
-            negative_prompt=negative,
-            num_inference_steps=int(steps),
-            guidance_scale=float(guidance),
-            height=H, width=W,
-            generator=gen,
-        )
+        run_pipe = pipe
+        call_kw = dict(height=H, width=W)
+
+    # 4) Memory plan: tiling/slicing only when this size/batch needs it
+    mem = cfg["memory"]
+    plan = plan_for_pipe(run_pipe, W, H, batch, int(steps),
+                         budget_gb=mem.get("budget_gb"), headroom=float(mem.get("headroom", 0.9)))
+    apply_plan(run_pipe, plan)
+
+    profiler = nullcontext()
+    if profile is True:
+        from anime2d.generate.profiling import JobProfiler, unique_profile_name
+        profiler = JobProfiler(unique_profile_name("art"))
+    elif profile:
+        profiler = profile
+
+    images = []
+    with profiler, track_peak(plan):
+        for start in range(0, batch, plan.batch_chunk):
+            n = min(plan.batch_chunk, batch - start)
+            # one generator per image keeps results independent of how the batch is chunked
+            gens = [torch.Generator(device=dev).manual_seed(base_seed + start + i) for i in range(n)]
+            result = run_pipe(
+                prompt=prompt,
+                negative_prompt=negative,
+                num_inference_steps=int(steps),
+                guidance_scale=float(guidance),
+                num_images_per_prompt=n,
+                generator=gens,
+                **call_kw,
+            )
+            images.extend(result.images)
+    record_plan(plan, Path(out_path).parent / "memory_plans.jsonl",
+                mode=("img2img" if ref_image else "txt2img"), scheduler=scheduler)
 
-    image = result.images[0]
-    image.save(out_path)
+    out_path = Path(out_path)
+    for i, image in enumerate(images):
+        image.save(out_path if i == 0 else out_path.with_name(f"{out_path.stem}_{i}{out_path.suffix}"))
     return out_path
@@ -0,0 +1,200 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import math
+import torch
+
+@dataclass
+class LatentCheckpoints:
+    """
+    Intermediate latents of one finished (or running) job.
+
+    `timesteps[i]` is the timestep processed by step i (0-based) and
+    `latents[i]` the latents right after it, kept on CPU for every
+    `stride`-th step. Resuming after step i means denoising from noise
+    level `timesteps[i + 1]` on.
+    """
+    params: Dict[str, Any]
+    stride: int = 1
+    timesteps: List[int] = field(default_factory=list)
+    latents: Dict[int, torch.Tensor] = field(default_factory=dict)
+
+    @property
+    def steps_done(self) -> int:
+        return len(self.timesteps)
+
+    def record(self, step: int, timestep, latents: torch.Tensor) -> None:
+        t = int(timestep.item() if torch.is_tensor(timestep) else timestep)
+        del self.timesteps[step:]
+        self.timesteps.append(t)
+        if step % self.stride == 0:
+            self.latents[step] = latents.detach().to("cpu", copy=True)
+
+    def resume_point(self, from_step: int) -> Tuple[int, torch.Tensor]:
+        """Latest stored step i with i < from_step (i.e. at most `from_step` steps done) and its latents."""
+        if not 1 <= from_step < self.steps_done:
+            raise ValueError(f"from_step must be in 1..{self.steps_done - 1}")
+        stored = [i for i in self.latents if i < from_step]
+        if not stored:
+            raise ValueError("no checkpoint at or before that step")
+        i = max(stored)
+        return i, self.latents[i]
+
+    def prefix(self, upto: int, params: Dict[str, Any], stride: Optional[int] = None) -> "LatentCheckpoints":
+        """
+        A new record sharing steps 0..upto (inclusive) with this one. A new
+        `stride` also thins the shared latents to it (step 0 is always kept).
+        """
+        stride = int(stride or self.stride)
+        return LatentCheckpoints(
+            params=params,
+            stride=stride,
+            timesteps=self.timesteps[:upto + 1],
+            latents={i: t for i, t in self.latents.items() if i <= upto and i % stride == 0},
+        )
+
+class LatentStore:
+    """
+    Per-session, holds the checkpoints of the most recent job only. Each job
+    gets a stride so its stored latents stay under `max_bytes`, which may be
+    a callable read at the start of every job (e.g. a live config value).
+    """
+    def __init__(self, max_bytes: int | Callable[[], int]):
+        self._max_bytes = max_bytes
+        self.latest: Optional[LatentCheckpoints] = None
+
+    @property
+    def max_bytes(self) -> int:
+        return int(self._max_bytes() if callable(self._max_bytes) else self._max_bytes)
+
+    def stride_for(self, steps: int, width: int, height: int) -> int:
+        per_step = 4 * (width // 8) * (height // 8) * 2   # SD1.x fp16 latents, batch 1
+        return max(1, math.ceil(steps * per_step / max(1, self.max_bytes)))
+
+    def begin(self, params: Dict[str, Any], steps: int, width: int, height: int) -> LatentCheckpoints:
+        self.latest = LatentCheckpoints(params=params, stride=self.stride_for(steps, width, height))
+        return self.latest
+
+    def keep(self, record: LatentCheckpoints) -> LatentCheckpoints:
+        self.latest = record
+        return record
+
+    def clear(self) -> None:
+        self.latest = None
+
+def _encode(pipe, prompt: str, negative: str, guidance: float) -> torch.Tensor:
+    do_cfg = guidance > 1.0
+    pos, neg = pipe.encode_prompt(prompt, pipe._execution_device, 1, do_cfg, negative_prompt=negative or None)
+    return torch.cat([neg, pos]) if do_cfg else pos
+
+def resume_schedule(sched, num_inference_steps: int, start_timestep: int, device=None) -> List[int]:
+    """
+    Timesteps a resume at noise level `start_timestep` runs on a
+    `num_inference_steps` schedule: `start_timestep` itself, then every grid
+    timestep below it. The first one is a bridge step (see resume_denoise)
+    unless the grid already contains it. Use the length for progress totals.
+    """
+    sched.set_timesteps(num_inference_steps, device=device)
+    tail = [int(t) for t in sched.timesteps if int(t) < int(start_timestep)]
+    return [int(start_timestep)] + tail
+
+def _sigma_space(sched) -> bool:
+    # Euler-family samplers keep latents as x0 + sigma * eps; the rest as sqrt(a) x0 + sqrt(1 - a) eps
+    return float(sched.init_noise_sigma) > 1.0
+
+def _bridge(sched, latents: torch.Tensor, noise: torch.Tensor, t_from: int, to_index: Optional[int]) -> torch.Tensor:
+    """
+    Deterministic (DDIM) move of `latents` from noise level `t_from` to the
+    scheduler's grid step `to_index` (None = fully denoised), given the model
+    output at `t_from`. Used when the grid has no step at `t_from`.
+    """
+    ac = sched.alphas_cumprod.to(device=latents.device, dtype=torch.float32)
+    a = ac[int(t_from)]
+    sigma_space = _sigma_space(sched)
+    x = latents.float() * a.sqrt() if sigma_space else latents.float()
+    if sched.config.prediction_type == "v_prediction":
+        x0 = a.sqrt() * x - (1 - a).sqrt() * noise.float()
+        eps = (1 - a).sqrt() * x + a.sqrt() * noise.float()
+    else:
+        eps = noise.float()
+        x0 = (x - (1 - a).sqrt() * eps) / a.sqrt()
+    if to_index is None:
+        return x0.to(latents.dtype)
+    if sigma_space:
+        # land exactly on the scheduler's own sigma for that step
+        out = x0 + sched.sigmas[to_index].to(x0.device, torch.float32) * eps
+    else:
+        b = ac[int(sched.timesteps[to_index])]
+        out = b.sqrt() * x0 + (1 - b).sqrt() * eps
+    return out.to(latents.dtype)
+
+@torch.no_grad()
+def resume_denoise(
+    pipe,
+    latents: torch.Tensor,
+    *,
+    num_inference_steps: int,
+    start_timestep: int,
+    segments: Sequence[Tuple[int, str, str, float]],
+    generator: Optional[torch.Generator] = None,
+    first_step: int = 0,
+    on_step: Optional[Callable[[int, Any, torch.Tensor], None]] = None,
+):
+    """
+    Continue denoising `latents` that sit at noise level `start_timestep`.
+
+    The steps are resume_schedule(): the first one denoises from exactly
+    `start_timestep`. When a new schedule (e.g. `continue` with more steps)
+    has no step there, that first step is a DDIM bridge onto its next grid
+    timestep instead of a scheduler step, so no noise level is skipped or
+    misread. `segments` is [(n_steps, prompt, negative, guidance), ...]; the
+    last segment's n_steps is ignored and it takes the rest, so a prompt can
+    change part-way. `on_step(step, t, latents)` gets global step indices
+    starting at `first_step`. Returns a PIL image.
+
+    Multistep solvers restart their history here, so the first resumed
+    step is first-order.
+    """
+    device = pipe._execution_device
+    sched = pipe.scheduler
+    timesteps = resume_schedule(sched, num_inference_steps, start_timestep, device=device)
+    # the scheduler's own timestep values (Euler rejects plain ints), by integer timestep
+    grid = {int(t): (i, t) for i, t in enumerate(sched.timesteps)}
+    bridge = timesteps[0] not in grid
+    extra = pipe.prepare_extra_step_kwargs(generator, 0.0)
+    latents = latents.to(device=device, dtype=pipe.unet.dtype)
+
+    step = first_step
+    pos = 0
+    for n, (seg_steps, prompt, negative, guidance) in enumerate(segments):
+        last = n == len(segments) - 1
+        seg_ts = timesteps[pos:] if last else timesteps[pos:pos + int(seg_steps)]
+        pos += len(seg_ts)
+        if not seg_ts:
+            continue
+        embeds = _encode(pipe, prompt, negative, guidance)
+        do_cfg = guidance > 1.0
+        for t_int in seg_ts:
+            is_bridge = bridge and step == first_step
+            t = torch.tensor(t_int, device=device) if is_bridge else grid[t_int][1]
+            inp = torch.cat([latents] * 2) if do_cfg else latents
+            if is_bridge:
+                # the UNet wants sqrt(a)-scaled input; sigma-space latents are x0 + sigma * eps
+                if _sigma_space(sched):
+                    inp = inp * sched.alphas_cumprod[t_int].to(inp.device, inp.dtype).sqrt()
+            else:
+                inp = sched.scale_model_input(inp, t)
+            noise = pipe.unet(inp, t, encoder_hidden_states=embeds, return_dict=False)[0]
+            if do_cfg:
+                uncond, cond = noise.chunk(2)
+                noise = uncond + guidance * (cond - uncond)
+            if is_bridge:
+                latents = _bridge(sched, latents, noise, t_int, grid[timesteps[1]][0] if len(timesteps) > 1 else None)
+            else:
+                latents = sched.step(noise, t, latents, **extra, return_dict=False)[0]
+            if on_step is not None:
+                on_step(step, t, latents)
+            step += 1
+
+    image = pipe.vae.decode(latents.to(pipe.vae.dtype) / pipe.vae.config.scaling_factor, return_dict=False)[0]
+    return pipe.image_processor.postprocess(image, output_type="pil")[0]
@@ -0,0 +1,193 @@
+from __future__ import annotations
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Any, Dict, Optional
+import json, time
+import torch
+import torch.nn.functional as F
+
+from anime2d.utils.paths import dated_output_dir
+
+GiB = 1024 ** 3
+
+# Rough SD1.x activation model, fp16 UNet / fp32 VAE decode (force_upcast).
+# Tuned to be a little pessimistic; compare against `measured_peak_bytes` in the log.
+_UNET_HEADS = 8
+_UNET_ACT_BYTES_PER_TOKEN = 320 * 2 * 30      # ~30 live 320-ch fp16 maps at the top UNet level
+_VAE_ACT_BYTES_PER_PIXEL = 128 * 4 * 6        # ~6 live 128-ch fp32 maps at full resolution
+_VAE_TILE_PX = 512                            # diffusers' default tile_sample_min_size for SD1.x
+_OVERHEAD_BYTES = int(0.35 * GiB)             # CUDA context, allocator slack, text encoder outputs
+
+@dataclass
+class MemoryPlan:
+    """Per-job memory decisions, plus what the job really used once it ran."""
+    width: int
+    height: int
+    batch: int
+    steps: int
+    budget_bytes: int
+    weights_bytes: int
+    estimate_bytes: int = 0
+    vae_tiling: bool = False
+    vae_slicing: bool = False
+    attention_slicing: Optional[str] = None   # None | "auto" | "max"
+    fused_attention: bool = False             # SDPA kernels: no tokens² score matrix, slicing not needed
+    batch_chunk: int = 1
+    fits: bool = True
+    measured_peak_bytes: Optional[int] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        d = asdict(self)
+        d["estimate_gb"] = round(self.estimate_bytes / GiB, 3)
+        d["measured_peak_gb"] = (round(self.measured_peak_bytes / GiB, 3)
+                                 if self.measured_peak_bytes is not None else None)
+        return d
+
+def weights_bytes(pipe) -> int:
+    """Bytes of every torch module the pipeline holds (cached on the pipe)."""
+    cached = getattr(pipe, "_anime2d_weights_bytes", None)
+    if cached is not None:
+        return cached
+    total = 0
+    for comp in pipe.components.values():
+        if isinstance(comp, torch.nn.Module):
+            total += sum(p.numel() * p.element_size() for p in comp.parameters())
+            total += sum(b.numel() * b.element_size() for b in comp.buffers())
+    pipe._anime2d_weights_bytes = total
+    return total
+
+def device_budget_bytes(budget_gb: float | None = None, headroom: float = 0.9) -> int:
+    """Configured budget, else `headroom` × total CUDA memory; unbounded on CPU."""
+    if budget_gb:
+        return int(float(budget_gb) * GiB)
+    if torch.cuda.is_available():
+        return int(torch.cuda.get_device_properties(0).total_memory * float(headroom))
+    return 1 << 62
+
+def fused_attention_available() -> bool:
+    """
+    True when diffusers' default attention (AttnProcessor2_0) runs on CUDA via
+    F.scaled_dot_product_attention, whose flash / memory-efficient kernels
+    never materialise the tokens × tokens score matrix.
+    """
+    return hasattr(F, "scaled_dot_product_attention") and torch.cuda.is_available()
+
+def _unet_bytes(width: int, height: int, chunk: int, attention_slicing: Optional[str], fused: bool) -> int:
+    tokens = (width // 8) * (height // 8)
+    cfg_batch = 2 * chunk   # classifier-free guidance doubles the UNet batch
+    attn = 0
+    if not fused:
+        heads = {None: _UNET_HEADS, "auto": _UNET_HEADS // 2, "max": 1}[attention_slicing]
+        attn = heads * tokens * tokens * 2 * cfg_batch
+    return attn + tokens * _UNET_ACT_BYTES_PER_TOKEN * cfg_batch
+
+def _vae_bytes(width: int, height: int, chunk: int, tiling: bool, slicing: bool, fused: bool) -> int:
+    if tiling:
+        width, height = min(width, _VAE_TILE_PX), min(height, _VAE_TILE_PX)
+    n = 1 if slicing else chunk
+    tokens = (width // 8) * (height // 8)
+    attn = 0 if fused else tokens * tokens * 4
+    return n * (width * height * _VAE_ACT_BYTES_PER_PIXEL + attn)
+
+def estimate_peak_bytes(width: int, height: int, batch: int, steps: int, *, weights: int,
+                        vae_tiling: bool = False, vae_slicing: bool = False,
+                        attention_slicing: Optional[str] = None, fused_attention: bool = False) -> int:
+    """
+    Peak = weights + overhead + max(UNet step, VAE decode); the two phases never
+    overlap. `steps` changes run time, not peak, and is kept for the log only.
+    With `fused_attention` the attention score matrices are not counted.
+    """
+    unet = _unet_bytes(width, height, batch, attention_slicing, fused_attention)
+    vae = _vae_bytes(width, height, batch, vae_tiling, vae_slicing, fused_attention)
+    return weights + _OVERHEAD_BYTES + max(unet, vae)
+
+def plan_memory(width: int, height: int, batch: int = 1, steps: int = 24, *,
+                weights: int, budget_bytes: int, fused_attention: bool = False) -> MemoryPlan:
+    """
+    Cheapest settings that fit the budget, escalating in order of cost:
+    VAE slicing → VAE tiling → attention slicing (auto, then max) → smaller batch chunks.
+    Attention slicing is skipped with `fused_attention`: under SDPA it only
+    swaps in a slower processor and saves nothing.
+    """
+    plan = MemoryPlan(width=width, height=height, batch=batch, steps=steps,
+                      budget_bytes=budget_bytes, weights_bytes=weights, batch_chunk=max(1, batch),
+                      fused_attention=fused_attention)
+
+    def _est() -> int:
+        return estimate_peak_bytes(width, height, plan.batch_chunk, steps, weights=weights,
+                                   vae_tiling=plan.vae_tiling, vae_slicing=plan.vae_slicing,
+                                   attention_slicing=plan.attention_slicing, fused_attention=fused_attention)
+
+    escalations = [
+        lambda: setattr(plan, "vae_slicing", plan.batch_chunk > 1),
+        lambda: setattr(plan, "vae_tiling", max(width, height) > _VAE_TILE_PX),
+    ]
+    if not fused_attention:
+        escalations += [
+            lambda: setattr(plan, "attention_slicing", "auto"),
+            lambda: setattr(plan, "attention_slicing", "max"),
+        ]
+    for step in escalations:
+        if _est() <= budget_bytes:
+            break
+        step()
+    while _est() > budget_bytes and plan.batch_chunk > 1:
+        plan.batch_chunk = max(1, plan.batch_chunk // 2)
+
+    plan.estimate_bytes = _est()
+    plan.fits = plan.estimate_bytes <= budget_bytes
+    return plan
+
+def plan_for_pipe(pipe, width: int, height: int, batch: int = 1, steps: int = 24, *,
+                  budget_gb: float | None = None, headroom: float = 0.9, reserve_bytes: int = 0) -> MemoryPlan:
+    """`reserve_bytes` is taken off the budget for memory held elsewhere (e.g. a second model loading)."""
+    weights = weights_bytes(pipe)
+    if not torch.cuda.is_available():
+        # model CPU offload: only the largest module sits on the accelerator at a time
+        unet = getattr(pipe, "unet", None)
+        if isinstance(unet, torch.nn.Module):
+            weights = sum(p.numel() * p.element_size() for p in unet.parameters())
+    return plan_memory(width, height, batch, steps, weights=weights,
+                       budget_bytes=max(0, device_budget_bytes(budget_gb, headroom) - int(reserve_bytes)),
+                       fused_attention=fused_attention_available())
+
+def apply_plan(pipe, plan: MemoryPlan) -> None:
+    """Toggle the pipeline's memory features to match `plan` (shared modules → affects sibling pipes)."""
+    vae = pipe.vae
+    if bool(getattr(vae, "use_tiling", False)) != plan.vae_tiling:
+        pipe.enable_vae_tiling() if plan.vae_tiling else pipe.disable_vae_tiling()
+    if bool(getattr(vae, "use_slicing", False)) != plan.vae_slicing:
+        pipe.enable_vae_slicing() if plan.vae_slicing else pipe.disable_vae_slicing()
+    # UNet keeps no public flag for this, so remember what we last set
+    if getattr(pipe.unet, "_anime2d_attn_slice", None) != plan.attention_slicing:
+        if plan.attention_slicing:
+            pipe.enable_attention_slicing(plan.attention_slicing)
+        else:
+            pipe.disable_attention_slicing()
+        pipe.unet._anime2d_attn_slice = plan.attention_slicing
+
+@contextmanager
+def track_peak(plan: MemoryPlan):
+    """Fill `plan.measured_peak_bytes` with the CUDA allocator peak over the block."""
+    cuda = torch.cuda.is_available()
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    try:
+        yield plan
+    finally:
+        if cuda:
+            torch.cuda.synchronize()
+            plan.measured_peak_bytes = int(torch.cuda.max_memory_allocated())
+
+def record_plan(plan: MemoryPlan, log_path: Path | None = None, **extra) -> Path:
+    """Append plan + measured peak as one JSON line (default: outputs/<date>/memory_plans.jsonl)."""
+    if log_path is None:
+        log_path = dated_output_dir() / "memory_plans.jsonl"
+    log_path = Path(log_path)
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    row = {"time": time.time(), **plan.to_dict(), **extra}
+    with log_path.open("a", encoding="utf-8") as f:
+        f.write(json.dumps(row) + "\n")
+    return log_path
@@ -0,0 +1,100 @@
+from __future__ import annotations
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+import sys, threading, time, uuid
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+from anime2d.utils.paths import dated_output_dir
+from datetime import datetime
+
+def profiles_dir(date_str: str | None = None) -> Path:
+    """outputs/<date>/profiles (does not create it)."""
+    return dated_output_dir(date_str) / "profiles"
+
+def unique_profile_name(prefix: str) -> str:
+    """`<prefix>_<HHMMSS>_<random>`: readable, but two runs in the same second don't collide."""
+    return f"{prefix}_{datetime.now().strftime('%H%M%S')}_{uuid.uuid4().hex[:6]}"
+
+class _StackSampler(threading.Thread):
+    """Samples one thread's Python stack every `interval_s` and counts folded stacks."""
+    def __init__(self, target_ident: int, interval_s: float):
+        super().__init__(name="anime2d-stack-sampler", daemon=True)
+        self.target_ident = target_ident
+        self.interval_s = interval_s
+        self.counts: Counter[str] = Counter()
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.wait(self.interval_s):
+            frame = sys._current_frames().get(self.target_ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+
+    def halt(self):
+        self._halt.set()
+        self.join()
+
+class JobProfiler:
+    """
+    Context manager wrapping a single job in torch.profiler plus a Python
+    stack sampler for the calling thread. On exit writes, under `out_dir`:
+
+      <name>.trace.json   Chrome trace (chrome://tracing, Perfetto)
+      <name>.folded.txt   folded stacks for flamegraph.pl / speedscope
+      <name>.ops.txt      top torch ops by total time
+
+    Enter it on the thread that does the work (e.g. inside the executor call).
+    """
+    def __init__(self, name: str, out_dir: Path | None = None, interval_s: float = 0.005):
+        self.name = name
+        self.out_dir = Path(out_dir) if out_dir is not None else profiles_dir()
+        self.interval_s = interval_s
+        self.trace_path: Optional[Path] = None
+        self.stacks_path: Optional[Path] = None
+        self.ops_path: Optional[Path] = None
+        self.wall_s: Optional[float] = None
+        self._prof = None
+        self._sampler: Optional[_StackSampler] = None
+        self._t0 = 0.0
+
+    def __enter__(self) -> "JobProfiler":
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        self._prof = profile(activities=activities, record_shapes=True, profile_memory=True)
+        self._sampler = _StackSampler(threading.get_ident(), self.interval_s)
+        self._t0 = time.perf_counter()
+        self._prof.__enter__()
+        self._sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._sampler.halt()
+        self._prof.__exit__(exc_type, exc, tb)
+        self.wall_s = time.perf_counter() - self._t0
+        if exc_type is None:
+            self._write()
+        return False
+
+    def _write(self) -> None:
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.trace_path = self.out_dir / f"{self.name}.trace.json"
+        self.stacks_path = self.out_dir / f"{self.name}.folded.txt"
+        self.ops_path = self.out_dir / f"{self.name}.ops.txt"
+
+        self._prof.export_chrome_trace(str(self.trace_path))
+        with self.stacks_path.open("w", encoding="utf-8") as f:
+            for stack, n in self._sampler.counts.most_common():
+                f.write(f"{stack} {n}\n")
+        sort_by = "cuda_time_total" if torch.cuda.is_available() else "cpu_time_total"
+        self.ops_path.write_text(
+            f"wall: {self.wall_s:.3f}s\n\n" + self._prof.key_averages().table(sort_by=sort_by, row_limit=40),
+            encoding="utf-8",
+        )
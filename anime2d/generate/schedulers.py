@@ -0,0 +1,69 @@
+from __future__ import annotations
+from typing import Any, Dict
+import threading
+from diffusers import (
+    DDIMScheduler,
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    EulerDiscreteScheduler,
+    UniPCMultistepScheduler,
+)
+
+# name -> (scheduler class, extra from_config kwargs)
+# The multistep solvers (dpmpp_2m*, unipc) stay usable down to ~6-10 steps.
+# Sigma options are spelled out so a name means the same whatever config it is built from.
+SCHEDULERS: Dict[str, tuple[type, Dict[str, Any]]] = {
+    "dpmpp_2m": (DPMSolverMultistepScheduler, {"use_karras_sigmas": False}),
+    "dpmpp_2m_karras": (DPMSolverMultistepScheduler, {"use_karras_sigmas": True}),
+    "unipc": (UniPCMultistepScheduler, {"use_karras_sigmas": False}),
+    "euler": (EulerDiscreteScheduler, {"use_karras_sigmas": False}),
+    "euler_a": (EulerAncestralDiscreteScheduler, {}),
+    "ddim": (DDIMScheduler, {}),
+}
+
+DEFAULT_SCHEDULER = "dpmpp_2m"
+
+def resolve_scheduler_name(name: str | None) -> str:
+    """Normalise a user-supplied scheduler name; empty means the default."""
+    key = (name or DEFAULT_SCHEDULER).strip().lower().replace("-", "_")
+    if key not in SCHEDULERS:
+        raise ValueError(f"unknown scheduler {name!r} (choose from: {', '.join(SCHEDULERS)})")
+    return key
+
+def build_scheduler(name: str | None, base_config):
+    cls, extra = SCHEDULERS[resolve_scheduler_name(name)]
+    return cls.from_config(base_config, **extra)
+
+class SchedulerCache:
+    """
+    One scheduler instance per name, built lazily from a pipeline's scheduler config.
+
+    Instances are stateful (timesteps, multistep history) but every pipeline call
+    starts with `set_timesteps`, which resets them, so an instance can be reused
+    by consecutive jobs. Callers must not run two jobs on one instance at once.
+    """
+    def __init__(self, base_config):
+        self._base_config = base_config
+        self._cache: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str | None):
+        key = resolve_scheduler_name(name)
+        with self._lock:
+            sched = self._cache.get(key)
+            if sched is None:
+                sched = build_scheduler(key, self._base_config)
+                self._cache[key] = sched
+            return sched
+
+    def build(self, name: str | None):
+        """A fresh, uncached instance, for side calculations that must not touch the shared one."""
+        return build_scheduler(name, self._base_config)
+
+    def apply(self, name: str | None, *pipes) -> str:
+        """Point every given pipeline at the cached scheduler `name`; returns the resolved name."""
+        key = resolve_scheduler_name(name)
+        sched = self.get(key)
+        for p in pipes:
+            p.scheduler = sched
+        return key
@@ -0,0 +1,173 @@
+# anime2d/pipeline.py
+from __future__ import annotations
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+import queue, threading, time, traceback
+
+from anime2d.utils.config import load_config
+from anime2d.utils.paths import dated_output_dir
+
+_DONE = object()  # end-of-stream marker between stages
+
+@dataclass
+class StageStats:
+    name: str
+    workers: int
+    items: int = 0
+    errors: int = 0
+    busy_s: float = 0.0      # inside the stage function
+    starved_s: float = 0.0   # waiting for input
+    blocked_s: float = 0.0   # waiting for room downstream (backpressure)
+    error_messages: List[str] = field(default_factory=list)
+
+    def utilisation(self, wall_s: float) -> float:
+        return self.busy_s / max(1e-9, wall_s * self.workers)
+
+@dataclass
+class Stage:
+    """`fn(item) -> item` run by `workers` threads; `setup()` (optional) builds per-thread state passed as `fn(item, state)`."""
+    name: str
+    fn: Callable[..., Any]
+    workers: int = 1
+    setup: Optional[Callable[[], Any]] = None
+
+def run_stages(items: Iterable[Any], stages: List[Stage], queue_size: int = 2) -> Tuple[List[Any], List[StageStats], float]:
+    """
+    Stream `items` through `stages`, each stage on its own thread pool, with
+    bounded queues in between so a fast stage runs at most `queue_size` items
+    ahead of a slow one. A failing item is dropped (counted in its stage's
+    stats); the rest keep flowing. Returns (outputs of the last stage, stats, wall seconds).
+    """
+    qs = [queue.Queue(maxsize=max(1, queue_size)) for _ in range(len(stages) + 1)]
+    qs[-1] = queue.Queue()  # collected results: unbounded
+    stats = [StageStats(s.name, max(1, s.workers)) for s in stages]
+    lock = threading.Lock()
+    alive = [max(1, s.workers) for s in stages]
+
+    def _worker(k: int):
+        stage, st, q_in, q_out = stages[k], stats[k], qs[k], qs[k + 1]
+        state, setup_error = None, None
+        try:
+            if stage.setup is not None:
+                t0 = time.perf_counter()
+                try:
+                    state = stage.setup()
+                except Exception as e:
+                    # keep draining input so upstream never blocks on a dead stage
+                    setup_error = e
+                    traceback.print_exc()
+                with lock:
+                    st.busy_s += time.perf_counter() - t0
+            while True:
+                t0 = time.perf_counter()
+                item = q_in.get()
+                t1 = time.perf_counter()
+                if item is _DONE:
+                    q_in.put(_DONE)  # let sibling workers see it too
+                    break
+                try:
+                    if setup_error is not None:
+                        raise RuntimeError(f"{stage.name} setup failed: {setup_error}")
+                    out = stage.fn(item, state) if stage.setup is not None else stage.fn(item)
+                    ok = True
+                except Exception as e:
+                    ok = False
+                    with lock:
+                        st.errors += 1
+                        st.error_messages.append(f"{type(e).__name__}: {e}")
+                    traceback.print_exc()
+                t2 = time.perf_counter()
+                if ok:
+                    q_out.put(out)
+                t3 = time.perf_counter()
+                with lock:
+                    st.starved_s += t1 - t0
+                    st.busy_s += t2 - t1
+                    st.blocked_s += t3 - t2
+                    st.items += int(ok)
+        finally:
+            with lock:
+                alive[k] -= 1
+                last = alive[k] == 0
+            if last:
+                q_out.put(_DONE)
+
+    t_start = time.perf_counter()
+    threads = [threading.Thread(target=_worker, args=(k,), name=f"{s.name}-{i}", daemon=True)
+               for k, s in enumerate(stages) for i in range(max(1, s.workers))]
+    for t in threads:
+        t.start()
+    for item in items:
+        qs[0].put(item)
+    qs[0].put(_DONE)
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t_start
+
+    results = []
+    while True:
+        item = qs[-1].get()
+        if item is _DONE:
+            break
+        results.append(item)
+    return results, stats, wall
+
+# ──────────────────────────────────────────────────────────────────────────────
+# art → upscale → split
+# ──────────────────────────────────────────────────────────────────────────────
+def run_art_pipeline(prompts: List[str], cfg_path: Path | str, out_dir: Path | None = None,
+                     workers: Dict[str, int] | None = None, queue_size: int | None = None,
+                     no_matte: bool = False) -> Tuple[List[Dict[str, Any]], List[StageStats], float]:
+    """
+    One item per prompt: outputs <out_dir>/<NNN>_art.png, _art_up.png (if the
+    upscaler is configured and available) and _layers.psd. Seeds run seed, seed+1, ...
+    Each art worker owns a warm pipeline; keep it at 1 per GPU.
+    """
+    cfg = load_config(cfg_path)
+    pcfg = cfg["pipeline"]
+    n_workers = {**pcfg["workers"], **(workers or {})}
+    queue_size = int(queue_size or pcfg["queue_size"])
+    out_dir = Path(out_dir) if out_dir is not None else dated_output_dir() / "pipeline"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    base_seed = int(cfg.get("seed") or 0)
+
+    def _art_setup():
+        from anime2d.generate.art import build_art_pipe
+        return build_art_pipe(cfg_path)
+
+    def _art(item, pipe):
+        from anime2d.generate.art import generate_art
+        item["art"] = generate_art(item["prompt"], out_dir / f"{item['index']:03d}_art.png",
+                                   cfg_path=cfg_path, seed=base_seed + item["index"], pipe=pipe)
+        return item
+
+    up = cfg["upscale"]
+    def _upscale(item):
+        item["upscaled"] = item["art"]
+        if str(up.get("impl", "none")).lower() not in ("", "none"):
+            from anime2d.generate.upscale import realesrgan_upscale
+            dst = item["art"].with_name(item["art"].stem + "_up.png")
+            if realesrgan_upscale(item["art"], dst, model_name=up.get("model", "realesrgan-x4plus-anime")):
+                item["upscaled"] = dst
+        return item
+
+    split_cfg = cfg["split"]
+    def _split(item):
+        from anime2d.split.split import split_to_psd
+        from anime2d.split.parts import backends_from_config
+        item["psd"], item["matte"] = split_to_psd(
+            item["upscaled"], out_dir / f"{item['index']:03d}_layers.psd", no_matte=no_matte,
+            backends=backends_from_config(split_cfg),
+            post_morphology=bool(split_cfg.get("post_morphology", True)),
+        )
+        return item
+
+    stages = [
+        Stage("art", _art, int(n_workers["art"]), setup=_art_setup),
+        Stage("upscale", _upscale, int(n_workers["upscale"])),
+        Stage("split", _split, int(n_workers["split"])),
+    ]
+    items = ({"index": i, "prompt": p} for i, p in enumerate(prompts))
+    results, stats, wall = run_stages(items, stages, queue_size=queue_size)
+    return sorted(results, key=lambda r: r["index"]), stats, wall
@@ -0,0 +1,393 @@
+"""
+Part segmentation for the PSD scaffold.
+
+A backend takes the matted RGBA array (H, W, 4, uint8) and the label map built
+so far (H, W, int16; -1 = unassigned, else an index into PART_NAMES) and returns
+a new label map. Backends run in order, so the fast `cluster` backend lays down
+a full first guess and heavier model backends refine it where they are sure.
+Model sessions are loaded once per process and kept warm.
+"""
+from __future__ import annotations
+import functools, threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import warnings
+import numpy as np
+import cv2
+from PIL import Image as PILImage
+
+from anime2d.utils.paths import get_paths
+
+# Leaf layer names of split.SCAFFOLD that a backend may fill (groups without sublayers fill themselves)
+PART_NAMES: List[str] = [
+    "Head",
+    "EyeL_Sclera", "EyeL_Iris", "EyeL_Pupil", "EyeR_Sclera", "EyeR_Iris", "EyeR_Pupil",
+    "Eyelid_Upper", "Eyelid_Lower",
+    "BrowL", "BrowR",
+    "Mouth_Upper", "Mouth_Lower", "Teeth", "Tongue",
+    "Hair_Front", "Hair_Side", "Hair_Back", "Accessories",
+    "Neck", "Torso",
+    "ArmL", "ArmR",
+]
+PART_INDEX: Dict[str, int] = {n: i for i, n in enumerate(PART_NAMES)}
+UNASSIGNED = -1
+
+Backend = Callable[[np.ndarray, np.ndarray], np.ndarray]
+BACKENDS: Dict[str, Backend] = {}
+
+class BackendUnavailable(RuntimeError):
+    """Optional dependency or model weights for a backend are missing."""
+
+def _load_once(fn):
+    """
+    Like lru_cache(maxsize=1) for zero-arg loaders, but the first call is
+    serialised (parallel split workers load one model, not one each) and a
+    BackendUnavailable is cached too, so a missing optional backend is
+    looked up once per process rather than once per image.
+    """
+    lock = threading.Lock()
+    state: dict = {}
+
+    @functools.wraps(fn)
+    def wrapper():
+        if not state:
+            with lock:
+                if not state:
+                    try:
+                        state["value"] = fn()
+                    except BackendUnavailable as e:
+                        state["error"] = e
+        if "error" in state:
+            raise state["error"]
+        return state["value"]
+    return wrapper
+
+def register_backend(name: str):
+    def deco(fn: Backend) -> Backend:
+        BACKENDS[name] = fn
+        return fn
+    return deco
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Default backend: colour/position k-means + layout heuristics (numpy only)
+# Left/right follow Live2D naming: "L" is the character's left = viewer's right.
+# ──────────────────────────────────────────────────────────────────────────────
+def _kmeans(X: np.ndarray, k: int, iters: int = 12, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = X[rng.choice(len(X), size=min(k, len(X)), replace=False)].copy()
+    for _ in range(iters):
+        lab = _nearest(X, centers)
+        counts = np.bincount(lab, minlength=len(centers)).astype(np.float32)
+        sums = np.stack([np.bincount(lab, weights=X[:, d], minlength=len(centers))
+                         for d in range(X.shape[1])], axis=1)
+        keep = counts > 0
+        centers[keep] = sums[keep] / counts[keep, None]
+    return centers
+
+def _nearest(X: np.ndarray, centers: np.ndarray, chunk: int = 262144) -> np.ndarray:
+    out = np.empty(len(X), dtype=np.int32)
+    c2 = (centers ** 2).sum(1)
+    for s in range(0, len(X), chunk):
+        x = X[s:s + chunk]
+        # |x-c|^2 without the |x|^2 term (constant per row)
+        out[s:s + chunk] = (c2[None, :] - 2.0 * x @ centers.T).argmin(1)
+    return out
+
+def _is_skin(rgb: np.ndarray) -> np.ndarray:
+    """Anime skin tones: warm, light, lightly saturated. rgb in [0, 1], shape (..., 3)."""
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    return (r >= g) & (g >= b) & (r > 0.72) & ((r - b) > 0.04) & ((r - b) < 0.38)
+
+def _largest_component(mask: np.ndarray) -> np.ndarray:
+    n, lab, stats, _ = cv2.connectedComponentsWithStats(mask.astype(np.uint8), connectivity=8)
+    if n <= 1:
+        return np.zeros_like(mask, dtype=bool)
+    best = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+    return lab == best
+
+def _fill_holes(mask: np.ndarray) -> np.ndarray:
+    """mask plus every background region not connected to the image border."""
+    n, lab = cv2.connectedComponents((~mask).astype(np.uint8), connectivity=4)
+    border = np.unique(np.concatenate([lab[0], lab[-1], lab[:, 0], lab[:, -1]]))
+    return mask | (~mask & ~np.isin(lab, border))
+
+def _bbox(mask: np.ndarray) -> Optional[Tuple[int, int, int, int]]:
+    ys, xs = np.nonzero(mask)
+    if len(ys) == 0:
+        return None
+    return int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
+
+@register_backend("cluster")
+def cluster_backend(rgba: np.ndarray, labels: np.ndarray, *, k: int = 8,
+                    pos_weight: float = 0.6, max_fit_px: int = 20000) -> np.ndarray:
+    H, W = rgba.shape[:2]
+    fg = rgba[..., 3] > 127
+    box = _bbox(fg)
+    labels = labels.copy()
+    if box is None:
+        return labels
+    bx0, by0, bx1, by1 = box
+    rgb = rgba[..., :3].astype(np.float32) / 255.0
+    yy, xx = np.mgrid[0:H, 0:W].astype(np.float32)
+    yn = (yy - by0) / max(1, by1 - by0)
+    xn = (xx - bx0) / max(1, bx1 - bx0)
+
+    # 1) k-means over (r, g, b, y, x) of foreground pixels, fitted on a subsample
+    idx = np.flatnonzero(fg)
+    X = np.concatenate([rgb.reshape(-1, 3)[idx],
+                        pos_weight * yn.reshape(-1, 1)[idx],
+                        pos_weight * xn.reshape(-1, 1)[idx]], axis=1)
+    fit = X[np.random.default_rng(0).choice(len(X), size=min(max_fit_px, len(X)), replace=False)]
+    centers = _kmeans(fit, k)
+    cl = np.full(H * W, -1, dtype=np.int32)
+    cl[idx] = _nearest(X, centers)
+    cl = cl.reshape(H, W)
+
+    skin_cl = np.flatnonzero(_is_skin(centers[:, :3]))
+    skin = np.isin(cl, skin_cl) & fg
+    # hair: the largest non-skin cluster whose mass sits in the upper part of the figure
+    hair_cl = [c for c in range(len(centers))
+               if c not in skin_cl and centers[c, 3] / pos_weight < 0.45]
+    if hair_cl:
+        areas = [(cl == c).sum() for c in hair_cl]
+        top = hair_cl[int(np.argmax(areas))]
+        # similar-coloured upper clusters are the same hair in another shade
+        hair_cl = [c for c in hair_cl
+                   if np.linalg.norm(centers[c, :3] - centers[top, :3]) < 0.25]
+    hair = np.isin(cl, hair_cl) & fg
+
+    def claim(name: str, mask: np.ndarray) -> None:
+        labels[(labels == UNASSIGNED) & mask & fg] = PART_INDEX[name]
+
+    # 2) face = largest skin blob in the upper 60% of the figure, cut at the chin
+    face = _largest_component(skin & (yn < 0.6))
+    if face.any():
+        rows = _fill_holes(face).sum(1)   # eyes/mouth must not read as a narrowing
+        narrow = np.flatnonzero((np.arange(H) > rows.argmax()) & (rows < 0.6 * rows.max()))
+        if narrow.size:
+            face[narrow[0]:] = False
+    fbox = _bbox(face)
+    if fbox is not None:
+        fx0, fy0, fx1, fy1 = fbox
+        fw, fh = fx1 - fx0, fy1 - fy0
+        inside = np.zeros_like(fg)
+        inside[fy0:fy1, fx0:fx1] = True
+        # whatever the face skin encloses: eyes, brows, mouth (even if hair-coloured)
+        closed = cv2.morphologyEx(face.astype(np.uint8), cv2.MORPH_CLOSE,
+                                  np.ones((max(3, fh // 12),) * 2, np.uint8)).astype(bool)
+        filled = _fill_holes(closed)
+        features = filled & inside & fg & ~face
+        _claim_face_features(features, rgb, fbox, claim)
+        claim("Head", filled & inside)
+
+        cx = (fx0 + fx1) / 2
+        # hair: bangs over the face, sides next to it, the rest hanging behind
+        claim("Hair_Front", hair & (xx >= fx0) & (xx < fx1) & (yy < fy0 + 0.6 * fh))
+        claim("Hair_Side", hair & (yy < fy1 + 0.25 * fh))
+        claim("Hair_Back", hair)
+
+        below = yy >= fy1 - 0.05 * fh
+        neck_band = below & (yy < fy1 + 0.45 * fh) & (np.abs(xx - cx) < 0.35 * fw)
+        claim("Neck", skin & neck_band)
+        # arms: skin off the centre line, or anything far out to the side below the face
+        arm = below & ((skin & (np.abs(xx - cx) > 0.5 * fw)) | (np.abs(xx - cx) > 0.9 * fw))
+        claim("ArmL", arm & (xx >= cx))
+        claim("ArmR", arm & (xx < cx))
+        claim("Torso", below & ~hair)
+    else:
+        claim("Hair_Back", hair)
+        claim("Torso", yn > 0.4)
+    return labels
+
+def _claim_face_features(features: np.ndarray, rgb: np.ndarray, fbox, claim) -> None:
+    fx0, fy0, fx1, fy1 = fbox
+    fw, fh = fx1 - fx0, fy1 - fy0
+    cx = (fx0 + fx1) / 2
+    n, lab, stats, cents = cv2.connectedComponentsWithStats(features.astype(np.uint8), connectivity=8)
+    comps = [i for i in range(1, n) if stats[i, cv2.CC_STAT_AREA] >= max(6, 0.002 * fw * fh)]
+    lum = rgb.mean(axis=2)
+
+    # eyes: two largest blobs in the middle band of the face
+    eyes = sorted((i for i in comps if 0.25 <= (cents[i][1] - fy0) / fh <= 0.8),
+                  key=lambda i: -stats[i, cv2.CC_STAT_AREA])[:2]
+    eye_top = fy1
+    for i in eyes:
+        m = lab == i
+        side = "L" if cents[i][0] >= cx else "R"
+        ex0, ey0, ew, eh = (int(stats[i, c]) for c in (cv2.CC_STAT_LEFT, cv2.CC_STAT_TOP,
+                                                       cv2.CC_STAT_WIDTH, cv2.CC_STAT_HEIGHT))
+        eye_top = min(eye_top, ey0)
+        rows = np.arange(rgb.shape[0])[:, None]
+        dark = lum < np.percentile(lum[m], 25)
+        claim("Eyelid_Upper", m & dark & (rows < ey0 + 0.25 * eh))
+        claim(f"Eye{side}_Sclera", m & (rgb.min(axis=2) > 0.85))
+        claim(f"Eye{side}_Pupil", m & dark)
+        claim(f"Eye{side}_Iris", m)
+
+    for i in comps:
+        if i in eyes:
+            continue
+        m = lab == i
+        v = (cents[i][1] - fy0) / fh
+        w, h = stats[i, cv2.CC_STAT_WIDTH], stats[i, cv2.CC_STAT_HEIGHT]
+        if cents[i][1] < eye_top and w > 1.8 * h:
+            claim("BrowL" if cents[i][0] >= cx else "BrowR", m)
+        elif v > 0.65 and abs(cents[i][0] - cx) < 0.25 * fw:
+            r, g = rgb[..., 0], rgb[..., 1]
+            upper = np.arange(rgb.shape[0])[:, None] < cents[i][1]
+            claim("Teeth", m & (rgb.min(axis=2) > 0.85))
+            claim("Tongue", m & ~upper & (r - g > 0.15) & (lum < np.percentile(lum[m], 50)))
+            claim("Mouth_Upper", m & upper)
+            claim("Mouth_Lower", m)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Optional model backends (warm sessions, loaded on first use)
+# ──────────────────────────────────────────────────────────────────────────────
+_SAM2_LOCK = threading.Lock()
+
+@_load_once
+def _sam2_generator():
+    try:
+        import torch
+        from sam2.build_sam import build_sam2
+        from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
+    except ImportError as e:
+        raise BackendUnavailable("sam2 is not installed (pip install sam2)") from e
+    ckpt = get_paths().models / "sam2" / "sam2_hiera_small.pt"
+    if not ckpt.exists():
+        raise BackendUnavailable(f"SAM2 checkpoint missing: {ckpt}")
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = build_sam2("sam2_hiera_s.yaml", str(ckpt), device=device)
+    return SAM2AutomaticMaskGenerator(model, points_per_side=24, min_mask_region_area=64)
+
+@register_backend("sam2")
+def sam2_backend(rgba: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    """Snap part boundaries to SAM2 segments: each segment takes its majority label."""
+    gen = _sam2_generator()
+    with _SAM2_LOCK:  # the generator keeps per-image predictor state
+        segs = gen.generate(np.ascontiguousarray(rgba[..., :3]))
+    out = labels.copy()
+    fg = rgba[..., 3] > 127
+    for seg in sorted(segs, key=lambda s: -s["area"]):
+        m = seg["segmentation"] & fg
+        votes = labels[m]
+        votes = votes[votes != UNASSIGNED]
+        if votes.size:
+            out[m] = np.bincount(votes).argmax()
+    return out
+
+# CelebAMask-HQ / BiSeNet label order, used by most (anime) face-parsing exports
+FACE_PARSE_LABELS = {
+    1: "Head", 2: "BrowL", 3: "BrowR", 4: "EyeL_Iris", 5: "EyeR_Iris",
+    7: "Head", 8: "Head", 10: "Head", 11: "Teeth", 12: "Mouth_Upper", 13: "Mouth_Lower",
+    14: "Neck", 16: "Torso", 17: "Hair_Front", 18: "Accessories",
+}
+
+@_load_once
+def _face_parse_session():
+    try:
+        import onnxruntime as ort
+    except ImportError as e:
+        raise BackendUnavailable("onnxruntime is not installed") from e
+    path = get_paths().models / "anime_face_parse" / "model.onnx"
+    if not path.exists():
+        raise BackendUnavailable(f"face-parsing model missing: {path}")
+    providers = [p for p in ("CUDAExecutionProvider", "CPUExecutionProvider") if p in ort.get_available_providers()]
+    return ort.InferenceSession(str(path), providers=providers)
+
+@register_backend("anime_face_parse")
+def face_parse_backend(rgba: np.ndarray, labels: np.ndarray, size: int = 512) -> np.ndarray:
+    """Face-parsing ONNX (1x3xSxS in, 1xCxSxS logits out) overrides labels on the face."""
+    sess = _face_parse_session()
+    H, W = rgba.shape[:2]
+    x = cv2.resize(rgba[..., :3], (size, size), interpolation=cv2.INTER_AREA).astype(np.float32) / 255.0
+    x = (x - np.array([0.485, 0.456, 0.406], np.float32)) / np.array([0.229, 0.224, 0.225], np.float32)
+    logits = sess.run(None, {sess.get_inputs()[0].name: x.transpose(2, 0, 1)[None]})[0][0]
+    cls = cv2.resize(logits.argmax(0).astype(np.uint8), (W, H), interpolation=cv2.INTER_NEAREST)
+    out = labels.copy()
+    fg = rgba[..., 3] > 127
+    # the model's hair class covers all hair; keep the cluster backend's front/side/back split there
+    hair_parts = {PART_INDEX[n] for n in ("Hair_Front", "Hair_Side", "Hair_Back")}
+    for c, name in FACE_PARSE_LABELS.items():
+        m = (cls == c) & fg
+        if name == "Hair_Front":
+            m &= ~np.isin(out, list(hair_parts))
+        out[m] = PART_INDEX[name]
+    return out
+
+# ──────────────────────────────────────────────────────────────────────────────
+def backends_from_config(split_cfg: dict) -> List[str]:
+    names = ["cluster"]
+    if split_cfg.get("use_sam2"):
+        names.append("sam2")
+    if split_cfg.get("use_anime_face_parse"):
+        names.append("anime_face_parse")
+    return names
+
+def segment_parts(rgba: PILImage.Image, backends: Iterable[str] = ("cluster",),
+                  post_morphology: bool = True) -> np.ndarray:
+    """Label map (H, W, int16) over PART_NAMES; optional backends that cannot load are skipped with a warning."""
+    arr = np.array(rgba.convert("RGBA"), dtype=np.uint8)
+    labels = np.full(arr.shape[:2], UNASSIGNED, dtype=np.int16)
+    for name in backends:
+        try:
+            labels = BACKENDS[name](arr, labels)
+        except BackendUnavailable as e:
+            warnings.warn(f"part backend {name!r} skipped: {e}", stacklevel=2)
+    if post_morphology:
+        labels = _clean(labels)
+    return labels
+
+def _clean(labels: np.ndarray) -> np.ndarray:
+    """Open each part mask to drop speckle; dropped pixels become unassigned."""
+    out = labels.copy()
+    kernel = np.ones((3, 3), np.uint8)
+    for i in np.unique(labels):
+        if i == UNASSIGNED:
+            continue
+        m = (labels == i).astype(np.uint8)
+        opened = cv2.morphologyEx(m, cv2.MORPH_OPEN, kernel).astype(bool)
+        out[(labels == i) & ~opened] = UNASSIGNED
+    return out
+
+def _claim_soft_edges(labels: np.ndarray, alpha: np.ndarray, max_dist: float = 8.0) -> np.ndarray:
+    """
+    Backends only label alpha > 127; give the semi-transparent pixels around
+    them (anti-aliased edges, hair wisps) the label of the nearest labelled
+    pixel within `max_dist`, so each part keeps its soft edge instead of it
+    all landing in "Unassigned". Opaque pixels no backend claimed stay unassigned.
+    """
+    seeds = labels != UNASSIGNED
+    soft = (alpha > 0) & (alpha <= 127) & ~seeds
+    if not soft.any() or not seeds.any():
+        return labels
+    src = np.where(seeds, 0, 255).astype(np.uint8)
+    dist, near = cv2.distanceTransformWithLabels(src, cv2.DIST_L2, 3, labelType=cv2.DIST_LABEL_PIXEL)
+    lut = np.full(int(near.max()) + 1, UNASSIGNED, dtype=np.int16)
+    lut[near[seeds]] = labels[seeds]
+    out = labels.copy()
+    take = soft & (dist <= max_dist)
+    out[take] = lut[near[take]]
+    return out
+
+def crop_parts(rgba: PILImage.Image, labels: np.ndarray) -> Dict[str, Tuple[PILImage.Image, Tuple[int, int]]]:
+    """
+    name -> (bbox-cropped RGBA, (left, top)) for every non-empty part, plus
+    "Unassigned" for matted pixels no part claimed. Soft-alpha edge pixels go
+    to the nearest part (see _claim_soft_edges).
+    """
+    arr = np.array(rgba.convert("RGBA"), dtype=np.uint8)
+    fg = arr[..., 3] > 0
+    labels = _claim_soft_edges(labels, arr[..., 3])
+    out: Dict[str, Tuple[PILImage.Image, Tuple[int, int]]] = {}
+    names = {i: n for i, n in enumerate(PART_NAMES)}
+    names[UNASSIGNED] = "Unassigned"
+    for i, name in names.items():
+        m = (labels == i) & fg
+        box = _bbox(m)
+        if box is None:
+            continue
+        x0, y0, x1, y1 = box
+        crop = arr[y0:y1, x0:x1].copy()
+        crop[..., 3] = np.where(m[y0:y1, x0:x1], crop[..., 3], 0)
+        out[name] = (PILImage.fromarray(crop, mode="RGBA"), (x0, y0))
+    return out
@@ -1,10 +1,12 @@
 ﻿from __future__ import annotations
 from pathlib import Path
-from typing import Tuple, List
+from typing import Dict, Iterable, Tuple, List
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import numpy as np
 from PIL import Image as PILImage
-from rembg import remove
+from rembg import remove, new_session
 from pytoshop.user import nested_layers as nl
 from pytoshop import enums  # stable location for ColorMode/ColorChannel
 
@@ -21,17 +23,31 @@ SCAFFOLD: List[tuple[str, List[str]]] = [
     ("Arms", ["ArmL","ArmR"]),
 ]
 
+_REMBG_SESSION = None
+_REMBG_LOCK = threading.Lock()
+
+def _rembg_session():
+    # one warm u2net session per process instead of a model load per image;
+    # the lock keeps parallel split_dir workers from each loading their own
+    global _REMBG_SESSION
+    if _REMBG_SESSION is None:
+        with _REMBG_LOCK:
+            if _REMBG_SESSION is None:
+                _REMBG_SESSION = new_session("u2net")
+    return _REMBG_SESSION
+
 def _alpha_matte_safe(in_png: Path) -> PILImage:
     """Run rembg on the PNG, return RGBA PIL.Image."""
     with open(in_png, "rb") as f:
         data = f.read()
-    out_bytes = remove(data)  # GPU if onnxruntime-gpu installed, else CPU
+    out_bytes = remove(data, session=_rembg_session())  # GPU if onnxruntime-gpu installed, else CPU
     return PILImage.open(BytesIO(out_bytes)).convert("RGBA")
 
-def _image_layer_from_rgba(name: str, rgba: PILImage, visible: bool=True) -> nl.Image:
+def _image_layer_from_rgba(name: str, rgba: PILImage, visible: bool=True, left: int=0, top: int=0) -> nl.Image:
     """
     Build a pytoshop nl.Image from RGBA with explicit channels & bounds.
     Avoid nl.Image.from_pil to ensure compatibility with Krita/Inochi.
+    `left`/`top` place a cropped image on the canvas.
     """
     rgba = rgba.convert("RGBA")
     W, H = rgba.size
@@ -42,7 +58,7 @@ def _image_layer_from_rgba(name: str, rgba: PILImage, visible: bool=True) -> nl.
         name=name,
         visible=visible,
         color_mode=enums.ColorMode.rgb,
-        top=0, left=0, right=W, bottom=H,
+        top=top, left=left, right=left + W, bottom=top + H,
     )
     # RGB channels
     layer.set_channel(enums.ColorChannel.red,   r)
@@ -113,20 +129,38 @@ def _write_psd_safe(out_psd: Path, layer_images: list[tuple[str, PILImage.Image]
 
 
 
-def build_psd_scaffold(matted_rgba: PILImage, out_psd: Path) -> Path:
+def build_psd_scaffold(matted_rgba: PILImage, out_psd: Path,
+                       parts: Dict[str, Tuple[PILImage.Image, Tuple[int, int]]] | None = None) -> Path:
+    """
+    `parts` maps scaffold layer names to (bbox-cropped RGBA, (left, top)) as
+    returned by parts.crop_parts; those layers are written cropped and visible,
+    and the full "Character" layer is kept hidden as a reference. Without parts
+    the scaffold layers stay empty and "Character" is visible.
+    """
     W, H = matted_rgba.size
+    parts = parts or {}
 
     # Prepare flat RGBA layers (no mask metadata)
-    layer_images: list[tuple[str, PILImage.Image]] = []
+    layer_images: list[tuple] = []
     layer_images.append(("Background", PILImage.new("RGBA", (W, H), (0,0,0,0))))  # hidden bg; keep as transparent
-    layer_images.append(("Character", matted_rgba))
+    layer_images.append(("Character", matted_rgba, (0, 0), not parts))
+
+    def _part_or_empty(name: str) -> tuple:
+        if name in parts:
+            im, offset = parts[name]
+            return (name, im, offset)
+        return (name, PILImage.new("RGBA", (W, H), (0,0,0,0)))
 
-    # Live2D-style empties as fully-transparent bitmaps (Creator-safe)
+    # Live2D-style layers; empty ones as fully-transparent bitmaps (Creator-safe)
     for group_name, sublayers in SCAFFOLD:
-        # put the group header as an empty layer (Creator will let you regroup inside if you want)
-        layer_images.append((group_name, PILImage.new("RGBA", (W, H), (0,0,0,0))))
+        # put the group header as an empty layer (Creator will let you regroup inside if you want);
+        # groups without sublayers (Head) carry the part themselves
+        layer_images.append(_part_or_empty(group_name) if not sublayers
+                            else (group_name, PILImage.new("RGBA", (W, H), (0,0,0,0))))
         for name in sublayers:
-            layer_images.append((name, PILImage.new("RGBA", (W, H), (0,0,0,0))))
+            layer_images.append(_part_or_empty(name))
+    if "Unassigned" in parts:
+        layer_images.append(_part_or_empty("Unassigned"))
 
     _write_psd_safe(out_psd, layer_images, (W, H))
     return out_psd
@@ -136,6 +170,9 @@ def split_to_psd(
     out_psd: Path,
     save_matte: bool = True,
     no_matte: bool = False,   # ← NEW
+    parts: bool = True,
+    backends: Iterable[str] = ("cluster",),
+    post_morphology: bool = True,
 ) -> Tuple[Path, Path | None]:
     out_psd.parent.mkdir(parents=True, exist_ok=True)
     matte_png = out_psd.with_name(out_psd.stem + "_matte.png")
@@ -155,22 +192,49 @@ def split_to_psd(
     if save_matte and not no_matte:
         rgba.save(matte_png)
 
-    build_psd_scaffold(rgba, out_psd)
+    layers = None
+    if parts:
+        from anime2d.split.parts import crop_parts, segment_parts
+        labels = segment_parts(rgba, backends=backends, post_morphology=post_morphology)
+        layers = crop_parts(rgba, labels)
+
+    build_psd_scaffold(rgba, out_psd, parts=layers)
     return out_psd, (None if (no_matte or not save_matte) else matte_png)
 
+def split_dir(
+    in_dir: Path,
+    out_dir: Path,
+    workers: int = 4,
+    pattern: str = "*.png",
+    **kwargs,
+) -> List[Tuple[Path, Path | None]]:
+    """
+    split_to_psd for every image in `in_dir` → out_dir/<stem>.psd. Images run on
+    a thread pool sharing the warm rembg/part-model sessions (matting and numpy
+    release the GIL for most of the work).
+    """
+    inputs = sorted(p for p in Path(in_dir).glob(pattern) if not p.stem.endswith("_matte"))
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(lambda p: split_to_psd(p, out_dir / f"{p.stem}.psd", **kwargs), inputs))
 
 
-def _write_psd_safe(out_psd: Path, layer_images: list[tuple[str, PILImage.Image]], size: tuple[int, int]) -> None:
+
+def _write_psd_safe(out_psd: Path, layer_images: list[tuple], size: tuple[int, int]) -> None:
     """
     Creator-safe via pytoshop: flat RGBA layers, no real masks/groups.
+    Entries are (name, image) or (name, image, (left, top)[, visible]).
     """
     layers_list: List[nl.Layer] = []
-    for name, im in layer_images:
-        # Visible unless explicitly Background
-        layers_list.append(_image_layer_from_rgba(name, im, visible=(name != "Background")))
+    for name, im, *rest in layer_images:
+        # optional (left, top) for cropped layers, and an explicit visibility
+        left, top = rest[0] if rest else (0, 0)
+        visible = rest[1] if len(rest) > 1 else (name != "Background")  # Visible unless explicitly Background
+        layers_list.append(_image_layer_from_rgba(name, im, visible=visible, left=left, top=top))
 
     # If everything is fully transparent, drop in a checkerboard DEBUG layer
-    if all(im.getextrema()[3] == (0, 0) for _, im in layer_images):
+    if all(entry[1].getextrema()[3] == (0, 0) for entry in layer_images):
         W, H = size
         tile = PILImage.new("RGBA", (32, 32), (0, 0, 0, 0))
         # make a simple checker
@@ -1,8 +1,8 @@
 # anime2d/utils/config.py
 from __future__ import annotations
 from pathlib import Path
-from typing import Any, Dict
-import copy
+from typing import Any, Dict, Tuple
+import copy, threading, warnings
 import yaml
 
 DEFAULT_CONFIG: Dict[str, Any] = {
@@ -11,6 +11,7 @@ DEFAULT_CONFIG: Dict[str, Any] = {
         "model": "waifu-diffusion/wd-1-5-beta3",
         "steps": 28,
         "guidance": 7.0,
+        "scheduler": "dpmpp_2m",
         "height": 768,
         "width": 512,
         "hires_fix": True,
@@ -20,6 +21,12 @@ DEFAULT_CONFIG: Dict[str, Any] = {
         },
         "loras": [],
         "negative": "blurry, extra arms, side view, profile",
+        # low-step, low-res preview sent before the full pass (web API `draft: true`)
+        "draft": {
+            "steps": 8,
+            "scale": 0.5,
+            "scheduler": None,  # None = the request's scheduler, so the preview matches the final
+        },
     },
     "upscale": {
         "impl": "realesrgan-ncnn",
@@ -56,6 +63,22 @@ DEFAULT_CONFIG: Dict[str, Any] = {
         "clone": "openvoice:v2",
         "loudness": -23,
     },
+    "memory": {
+        "budget_gb": None,   # accelerator memory the planner may use; None = headroom × device total
+        "headroom": 0.9,
+    },
+    "server": {
+        "job_ttl_s": 3600,          # how long finished REST jobs (and their images) are kept
+        "max_pending_jobs": 10000,  # queued + running REST jobs before POST /jobs answers 429
+        "latent_store_mb": 64,      # per-WS-session budget for kept latents (continue/branch)
+        "admin_token": None,        # enables admin-only features (profiling); or env ANIME2D_ADMIN_TOKEN
+        "model": None,              # path or HF repo id; None = models/wd15 if it is a diffusers folder, else sd.model
+        "config_poll_s": 2.0,       # how often the server re-checks this file; edits apply without a restart
+    },
+    "pipeline": {
+        "queue_size": 2,   # items a stage may run ahead of the next one
+        "workers": {"art": 1, "upscale": 1, "split": 2},  # art: one warm SD pipeline each
+    },
     "export": {
         "obs": {"spout_sender": "Inochi Session"},
         "unity": {"lipsync": "rhubarb"},
@@ -80,6 +103,50 @@ def load_config(path: Path | str) -> Dict[str, Any]:
         user_cfg = yaml.safe_load(f) or {}
     return _deep_merge(DEFAULT_CONFIG, user_cfg)
 
+_CACHE: Dict[Path, Tuple[Tuple[int, int], Dict[str, Any]]] = {}
+_CACHE_LOCK = threading.Lock()
+
+def _stamp(path: Path) -> Tuple[int, int]:
+    try:
+        st = path.stat()
+        return st.st_mtime_ns, st.st_size
+    except FileNotFoundError:
+        return 0, -1
+
+def _check_sections(default: Dict[str, Any], cfg: Dict[str, Any], where: str = "") -> None:
+    """Every section that is a mapping in DEFAULT_CONFIG must still be one (`server:` with no children loads as None)."""
+    for k, v in default.items():
+        if isinstance(v, dict):
+            if not isinstance(cfg.get(k), dict):
+                raise ValueError(f"section '{where}{k}' must be a mapping, got {type(cfg.get(k)).__name__}")
+            _check_sections(v, cfg[k], f"{where}{k}.")
+
+def load_config_cached(path: Path | str) -> Dict[str, Any]:
+    """
+    load_config for long-running processes: re-reads the file only when its
+    mtime/size changed, so it is cheap to call per request. The returned dict
+    is shared, don't mutate it. If an edit does not parse or leaves a section
+    empty (e.g. the file is caught half-written), the last good config is kept
+    until the file changes again.
+    """
+    path = Path(path).resolve()
+    stamp = _stamp(path)
+    with _CACHE_LOCK:
+        hit = _CACHE.get(path)
+        if hit is not None and hit[0] == stamp:
+            return hit[1]
+        try:
+            cfg = load_config(path)
+            _check_sections(DEFAULT_CONFIG, cfg)
+        except Exception as e:
+            if hit is None:
+                raise
+            warnings.warn(f"{path}: keeping previous config ({type(e).__name__}: {e})")
+            _CACHE[path] = (stamp, hit[1])  # don't re-parse the same bad file on every call
+            return hit[1]
+        _CACHE[path] = (stamp, cfg)
+        return cfg
+
 def save_default_config(path: Path | str, overwrite: bool = False) -> Path:
     path = Path(path)
     path.parent.mkdir(parents=True, exist_ok=True)
@@ -10,6 +10,8 @@ export default function App() {
   const [steps, setSteps] = useState(24)
   const [guidance, setGuidance] = useState(7.0)
   const [seed, setSeed] = useState<string>('123456')
+  const [scheduler, setScheduler] = useState('')  // '' = server default (sd.scheduler)
+  const [draft, setDraft] = useState(true)
 
   const [imgSrc, setImgSrc] = useState<string | null>(null)
   const [busy, setBusy] = useState(false)
@@ -40,6 +42,10 @@ export default function App() {
           if (typeof msg.step === 'number' && typeof msg.total === 'number') {
             setProgress({ step: msg.step, total: msg.total })
           }
+        } else if (msg.type === 'draft' && msg.image) {
+          setImgSrc(`data:image/png;base64,${msg.image}`)
+        } else if (msg.type === 'error') {
+          setBusy(false); setProgress(null)
         } else if (msg.type === 'final' && msg.image) {
           setImgSrc(`data:image/png;base64,${msg.image}`)
           setBusy(false); setProgress(null)
@@ -67,7 +73,9 @@ export default function App() {
       steps, guidance, width, height, negative,
       seed: seed.trim(),
       image: initImage || undefined,   // send only if present
-      strength
+      strength,
+      scheduler: scheduler || undefined,   // omitted → server's sd.scheduler
+      draft
     }))
   }
 
@@ -175,6 +183,27 @@ export default function App() {
               className="mt-2 w-full" />
           </div>
 
+          <div>
+            <label className="text-sm text-zinc-400">Sampler</label>
+            <select value={scheduler} onChange={(e) => setScheduler(e.target.value)}
+              className="mt-1 w-full p-2 rounded-xl bg-zinc-900 border border-zinc-700">
+              <option value="">Server default</option>
+              <option value="dpmpp_2m">DPM++ 2M</option>
+              <option value="dpmpp_2m_karras">DPM++ 2M Karras</option>
+              <option value="unipc">UniPC</option>
+              <option value="euler">Euler</option>
+              <option value="euler_a">Euler a</option>
+              <option value="ddim">DDIM</option>
+            </select>
+          </div>
+
+          <div className="flex items-end">
+            <label className="flex items-center gap-2 text-sm text-zinc-400">
+              <input type="checkbox" checked={draft} onChange={(e) => setDraft(e.target.checked)} />
+              Quick draft first
+            </label>
+          </div>
+
           <div className="col-span-2 flex items-center gap-2">
             <label className="text-sm text-zinc-400">Seed</label>
             <input
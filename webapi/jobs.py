@@ -0,0 +1,208 @@
+from __future__ import annotations
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+import asyncio, base64, itertools, threading, time, uuid
+
+# Job lifecycle: queued → running → done | error | cancelled
+TERMINAL_EVENTS = ("final", "error", "cancelled")
+_STATUS_FOR_EVENT = {
+    "started": "running",
+    "final": "done",
+    "error": "error",
+    "cancelled": "cancelled",
+}
+
+# Lower runs first; interactive (WebSocket) jobs jump ahead of queued batch work
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+
+class Job:
+    """
+    One generation request plus everything a client may ask about it later.
+
+    Events are plain dicts (`{"type": "started"|"progress"|"draft"|"final"|"error"|"cancelled", ...}`)
+    and must be published on the event-loop thread; worker threads go through
+    `loop.call_soon_threadsafe(job.publish, event)`.
+
+    Image payloads (base64 PNG in draft/final events) reach live subscribers
+    only. With `image_dir` set (REST jobs) they are written to
+    `<image_dir>/<id>.png` / `<id>_draft.png` and only the path is kept, so
+    finished jobs cost no heap; replayed events carry `image_url` instead.
+    """
+    def __init__(self, prompt: str, params: Dict[str, Any]):
+        self.id = uuid.uuid4().hex
+        self.prompt = prompt
+        self.params = params
+        self.status = "queued"
+        self.step = 0
+        self.total = int(params.get("steps") or 0)
+        self.draft: Optional[Dict[str, Any]] = None   # {"path": <png or None>, "meta": {...}}
+        self.result: Optional[Dict[str, Any]] = None  # {"path": <png or None>, "meta": {...}}
+        self.image_dir: Optional[Path] = None
+        self.image_url: Optional[str] = None          # what replayed events point at, e.g. /jobs/<id>/image
+        self.error: Optional[str] = None
+        self.created = time.time()
+        self.finished: Optional[float] = None
+        # checked from the diffusion thread between steps
+        self.cancel_event = threading.Event()
+        # WS jobs only: the session's LatentStore, and {"kind", "parent", ...} for continue/branch
+        self.latent_store: Any = None
+        self.resume: Optional[Dict[str, Any]] = None
+        self._history: List[Dict[str, Any]] = []
+        self._subscribers: List[asyncio.Queue] = []
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("done", "error", "cancelled")
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        if self.done:
+            return
+        kind = event.get("type")
+        if kind in _STATUS_FOR_EVENT:
+            self.status = _STATUS_FOR_EVENT[kind]
+        if kind == "started":
+            self.total = int(event.get("total") or self.total)
+            self.step = 0
+        elif kind == "progress":
+            self.step = int(event.get("step") or 0)
+        elif kind == "draft":
+            self.draft = {"path": self._save_image(event, "_draft"), "meta": event.get("meta")}
+        elif kind == "final":
+            self.step = self.total
+            self.result = {"path": self._save_image(event, ""), "meta": event.get("meta")}
+        elif kind == "error":
+            self.error = str(event.get("message") or "error")
+        if kind in TERMINAL_EVENTS:
+            self.finished = time.time()
+        if kind != "progress":
+            # progress is replayed from self.step instead of kept one by one;
+            # images are never kept here (see class docstring)
+            kept = {k: v for k, v in event.items() if k != "image"}
+            saved = {"draft": self.draft, "final": self.result}.get(kind)
+            if saved and saved["path"] and self.image_url:
+                kept["image_url"] = self.image_url + ("?draft=true" if kind == "draft" else "")
+            self._history.append(kept)
+        for q in self._subscribers:
+            q.put_nowait(event)
+
+    def _save_image(self, event: Dict[str, Any], suffix: str) -> Optional[str]:
+        if self.image_dir is None or not event.get("image"):
+            return None
+        self.image_dir.mkdir(parents=True, exist_ok=True)
+        path = self.image_dir / f"{self.id}{suffix}.png"
+        path.write_bytes(base64.b64decode(event["image"]))
+        return str(path)
+
+    def subscribe(self) -> asyncio.Queue:
+        """Queue that replays what happened so far, then receives live events."""
+        q: asyncio.Queue = asyncio.Queue()
+        for ev in self._history:
+            q.put_nowait(ev)
+        if self.status == "running" and self.step:
+            q.put_nowait({"type": "progress", "step": self.step, "total": self.total})
+        if not self.done:
+            self._subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q: asyncio.Queue) -> None:
+        if q in self._subscribers:
+            self._subscribers.remove(q)
+
+    def cancel(self) -> None:
+        if self.done:
+            return
+        self.cancel_event.set()
+        if self.status == "queued":
+            # never reached the worker; a running job reports its own cancellation
+            self.publish({"type": "cancelled"})
+
+    def to_dict(self, include_images: bool = True) -> Dict[str, Any]:
+        out: Dict[str, Any] = {
+            "id": self.id,
+            "status": self.status,
+            "prompt": self.prompt,
+            "step": self.step,
+            "total": self.total,
+            "created": self.created,
+            "finished": self.finished,
+            "error": self.error,
+        }
+        if self.result is not None:
+            out["meta"] = self.result.get("meta")
+            path = self.result.get("path")
+            if path and self.image_url:
+                out["image_url"] = self.image_url
+            if include_images and path and Path(path).exists():
+                # read back on demand; nothing is held in memory between requests
+                out["image"] = base64.b64encode(Path(path).read_bytes()).decode("ascii")
+        return out
+
+
+class JobQueue:
+    """
+    Priority queue drained by a single worker coroutine, so every job — REST or
+    WebSocket — runs on the one warm pipeline, one at a time.
+    """
+    def __init__(self, runner: Callable[[Job], Awaitable[None]]):
+        self._runner = runner
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._seq = itertools.count()
+
+    def _ensure_worker(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self._work())
+
+    def submit(self, job: Job, priority: int = PRIORITY_BATCH) -> Job:
+        self._ensure_worker()
+        self._queue.put_nowait((priority, next(self._seq), job))
+        return job
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _work(self) -> None:
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                if job.done:  # cancelled while waiting
+                    continue
+                await self._runner(job)
+            except asyncio.CancelledError:
+                job.publish({"type": "cancelled"})
+                raise
+            except Exception as e:
+                job.publish({"type": "error", "message": f"{type(e).__name__}: {e}"})
+            finally:
+                self._queue.task_done()
+
+
+class JobStore:
+    """REST-visible jobs by id; finished ones are dropped `ttl_s` seconds after they end."""
+    def __init__(self, ttl_s: float):
+        self.ttl_s = float(ttl_s)
+        self._jobs: Dict[str, Job] = {}
+
+    def add(self, job: Job) -> Job:
+        self.purge()
+        self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self.purge()
+        return self._jobs.get(job_id)
+
+    def pop(self, job_id: str) -> Optional[Job]:
+        return self._jobs.pop(job_id, None)
+
+    def pending(self) -> int:
+        return sum(1 for j in self._jobs.values() if not j.done)
+
+    def purge(self) -> None:
+        cutoff = time.time() - self.ttl_s
+        for jid in [jid for jid, j in self._jobs.items() if j.finished is not None and j.finished < cutoff]:
+            del self._jobs[jid]
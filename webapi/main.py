@@ -1,8 +1,10 @@
 from pathlib import Path
-from typing import Optional
-import torch, asyncio, json, base64
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import JSONResponse
+from typing import Optional, Union
+import torch, asyncio, json, base64, threading, gc, logging, os, re, secrets, time
+from contextlib import nullcontext
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from pydantic import BaseModel
 from io import BytesIO
 from diffusers import StableDiffusionImg2ImgPipeline
 from PIL import Image
@@ -10,12 +12,33 @@ import io
 
 from anime2d.generate.art import _build_base as build_base_pipe
 from anime2d.generate.art import _maybe_local
+from anime2d.generate.schedulers import SCHEDULERS, SchedulerCache, resolve_scheduler_name
+from anime2d.generate.checkpoints import LatentStore
+from anime2d.generate.memory import apply_plan, plan_for_pipe, record_plan, track_peak, weights_bytes
+from anime2d.utils.config import load_config_cached
+from anime2d.utils.paths import dated_output_dir
+from webapi.jobs import Job, JobQueue, JobStore, PRIORITY_BATCH, PRIORITY_INTERACTIVE, TERMINAL_EVENTS
+
+log = logging.getLogger(__name__)
 
 APP_ROOT = Path(__file__).resolve().parents[1]
+CONFIG_PATH = Path(os.environ.get("ANIME2D_CONFIG") or APP_ROOT / "configs" / "default.yaml")
 
-# Prefer THIS folder directly (since your model_index.json lives here)
+# Preferred model folder when server.model is unset (your model_index.json lives here)
 LOCAL_DIFFUSERS_DIR = APP_ROOT / "models" / "wd15"
-HUB_MODEL_ID = "waifu-diffusion/wd-1-5-beta3"
+SSE_KEEPALIVE_S = 15.0
+
+def _cfg() -> dict:
+    """
+    Current server config. Re-read whenever configs/default.yaml changes, so
+    defaults (sd:), draft, memory and server settings apply to the next job
+    without a restart; a model change swaps pipelines in the background.
+    """
+    return load_config_cached(CONFIG_PATH)
+
+def _admin_token() -> str:
+    # Admin-only features (per-job profiling); unset = disabled for everyone
+    return _cfg()["server"].get("admin_token") or os.environ.get("ANIME2D_ADMIN_TOKEN") or ""
 
 def _device() -> str:
     return "cuda" if torch.cuda.is_available() else "cpu"
@@ -23,35 +46,38 @@ def _device() -> str:
 def _has_model_index(p: Path) -> bool:
     return (p / "model_index.json").exists()
 
-_PIPELINE: Optional[object] = None
-_PIPELINE_LOCK = asyncio.Lock()
-
-async def get_pipeline():
-    global _PIPELINE
-    if _PIPELINE is not None:
-        return _PIPELINE
+def _is_admin(token: Optional[str]) -> bool:
+    admin = _admin_token()
+    return bool(admin) and bool(token) and secrets.compare_digest(str(token), str(admin))
 
+def _model_source(cfg: dict) -> tuple[str, bool]:
+    """(model id or folder, is_local) the server should be running for this config."""
+    model = cfg["server"].get("model")
+    if model:
+        p = Path(model) if Path(model).is_absolute() else APP_ROOT / model
+        return (p.as_posix(), True) if p.exists() else (str(model), False)
     # 1) If models/wd15 has model_index.json, load it as a diffusers folder
     if _has_model_index(LOCAL_DIFFUSERS_DIR):
-        sd_model_id = LOCAL_DIFFUSERS_DIR.as_posix()
-        sd_local = True
-    else:
-        # 2) Otherwise fall back to whatever _maybe_local finds (or the hub id)
-        sd_model_id, sd_local = _maybe_local(HUB_MODEL_ID, fallback_dir="wd15")
-
-    pipe = build_base_pipe(sd_model_id, local=sd_local)
-    _PIPELINE = pipe
-    return _PIPELINE
-
-_PIPELINE_TXT = None
-_PIPELINE_IMG = None
+        return LOCAL_DIFFUSERS_DIR.as_posix(), True
+    # 2) Otherwise fall back to whatever _maybe_local finds (or the hub id)
+    return _maybe_local(str(cfg["sd"]["model"]), fallback_dir="wd15")
 
-async def get_pipeline_pair():
-    global _PIPELINE_TXT, _PIPELINE_IMG
-    if _PIPELINE_TXT is not None and _PIPELINE_IMG is not None:
-        return _PIPELINE_TXT, _PIPELINE_IMG
-
-    base = await get_pipeline()  # your existing creator that returns txt2img
+# ──────────────────────────────────────────────────────────────────────────────
+# Pipelines: one warm set at a time, replaced without downtime when the model changes
+# ──────────────────────────────────────────────────────────────────────────────
+class PipelineSet:
+    """txt2img + img2img sharing one model's components, and that model's scheduler cache."""
+    def __init__(self, source: tuple[str, bool], txt2img, img2img, schedulers: SchedulerCache):
+        self.source = source
+        self.model = source[0]
+        self.txt2img = txt2img
+        self.img2img = img2img
+        self.schedulers = schedulers
+        self.loaded = time.time()
+
+def _load_pipeline_set(source: tuple[str, bool], scheduler: str) -> PipelineSet:
+    """Blocking cold load; runs in the executor."""
+    base = build_base_pipe(source[0], local=source[1], scheduler=scheduler)
     # Build img2img that shares components
     img2img = StableDiffusionImg2ImgPipeline(**base.components)
     img2img.scheduler = base.scheduler
@@ -59,10 +85,110 @@ async def get_pipeline_pair():
         img2img.to("cuda")
     else:
         img2img.enable_model_cpu_offload()
-    img2img.enable_vae_tiling()
-
-    _PIPELINE_TXT, _PIPELINE_IMG = base, img2img
-    return _PIPELINE_TXT, _PIPELINE_IMG
+    # seeded from the checkpoint's scheduler config, not the already-converted default one
+    base_config = getattr(base, "_anime2d_scheduler_config", base.scheduler.config)
+    return PipelineSet(source, base, img2img, SchedulerCache(base_config))
+
+def _warm_up(ps: PipelineSet) -> None:
+    """
+    One tiny generation so CUDA kernels/allocator are ready before the set takes
+    traffic. Runs between jobs (under the generation lock) so it never lands in
+    a live job's peak measurement.
+    """
+    with _GEN_LOCK, torch.inference_mode():
+        ps.txt2img(prompt="", num_inference_steps=2, guidance_scale=1.0, width=256, height=256,
+                   generator=torch.Generator(device=_device()).manual_seed(0))
+
+_PIPELINES: Optional[PipelineSet] = None
+_PIPELINE_LOCK = asyncio.Lock()      # first (cold) load only
+_SWAP_TASK: Optional[asyncio.Task] = None
+_SWAP_TARGET: Optional[tuple[str, bool]] = None
+_SWAP_ERROR: Optional[dict] = None   # last failed swap; not retried until the config file changes again
+_WATCHER: Optional[asyncio.Task] = None
+# Bumped when a background load starts and when it ends (odd = loading). Jobs that
+# overlap a load plan around the extra model and don't record a measured peak.
+_SWAP_LOADS = 0
+# One diffusion call at a time: the pipelines share UNet/VAE and the cached schedulers are stateful
+_GEN_LOCK = threading.Lock()
+
+async def get_pipelines() -> PipelineSet:
+    """
+    The active pipeline set. The first call loads it; later calls return it at
+    once and, if the config now names another model, start loading that one in
+    the background (see _swap_pipelines). Jobs keep the set they started with.
+    """
+    global _PIPELINES
+    if _PIPELINES is None:
+        async with _PIPELINE_LOCK:
+            if _PIPELINES is None:
+                cfg = _cfg()
+                scheduler = resolve_scheduler_name(cfg["sd"].get("scheduler"))
+                _PIPELINES = await asyncio.get_running_loop().run_in_executor(
+                    None, _load_pipeline_set, _model_source(cfg), scheduler)
+        return _PIPELINES
+    _maybe_swap()
+    return _PIPELINES
+
+def _maybe_swap() -> None:
+    global _SWAP_TASK, _SWAP_TARGET
+    if _PIPELINES is None:
+        return  # nothing loaded yet; the first job loads whatever the config says
+    if _SWAP_TASK is not None and not _SWAP_TASK.done():
+        return  # one load at a time; it re-checks the config when it ends
+    cfg = _cfg()
+    source = _model_source(cfg)
+    if source == _PIPELINES.source:
+        return
+    if _SWAP_ERROR is not None and _SWAP_ERROR["source"] == source and _SWAP_ERROR["cfg"] is cfg:
+        return
+    _SWAP_TARGET = source
+    _SWAP_TASK = asyncio.get_running_loop().create_task(_swap_pipelines(source, cfg))
+
+async def _swap_pipelines(source: tuple[str, bool], cfg: dict) -> None:
+    """
+    Load + warm the new model next to the live one, then switch over in one
+    assignment. The worker picks the new set up at its next job; a job already
+    running holds the old set and finishes on it, after which it is freed.
+    Needs memory for both models while the new one loads.
+    """
+    global _PIPELINES, _SWAP_TARGET, _SWAP_ERROR, _SWAP_LOADS
+    loop = asyncio.get_running_loop()
+    _SWAP_LOADS += 1
+    try:
+        scheduler = resolve_scheduler_name(cfg["sd"].get("scheduler"))
+        ps = await loop.run_in_executor(None, _load_pipeline_set, source, scheduler)
+        await loop.run_in_executor(None, _warm_up, ps)
+    except Exception as e:
+        _SWAP_ERROR = {"source": source, "cfg": cfg, "model": source[0], "error": f"{type(e).__name__}: {e}"}
+        log.exception("model swap to %s failed, still serving %s", source[0], _PIPELINES.model)
+        return
+    finally:
+        _SWAP_LOADS += 1
+        _SWAP_TARGET = None
+        # the config may have moved on while this one loaded
+        loop.call_soon(_maybe_swap)
+    old, _PIPELINES, _SWAP_ERROR = _PIPELINES, ps, None
+    log.info("now serving %s (was %s)", ps.model, old.model)
+    del old
+    # waits for a job still on the old set, then returns the freed memory to the allocator
+    loop.run_in_executor(None, _release_unused)
+
+def _release_unused() -> None:
+    with _GEN_LOCK:
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+async def _watch_config() -> None:
+    """Polls the config so model changes start loading before the next job arrives."""
+    while True:
+        try:
+            await asyncio.sleep(float(_cfg()["server"].get("config_poll_s") or 2.0))
+            _JOBS.ttl_s = float(_cfg()["server"]["job_ttl_s"])
+            _maybe_swap()
+        except Exception as e:  # a bad edit must not kill the watcher
+            log.warning("config check failed: %s: %s", type(e).__name__, e)
+            await asyncio.sleep(2.0)
 
 def _b64_to_pil(b64png: str) -> Image.Image:
     raw = base64.b64decode(b64png.split(",")[-1].encode("ascii"))
@@ -70,172 +196,397 @@ def _b64_to_pil(b64png: str) -> Image.Image:
 
 app = FastAPI()
 
+@app.on_event("startup")
+async def _start_config_watcher():
+    global _WATCHER
+    _WATCHER = asyncio.get_running_loop().create_task(_watch_config())
+
 @app.get("/health")
 async def health():
+    cfg = _cfg()
     return JSONResponse({
         "ok": True,
         "device": _device(),
-        "using": (LOCAL_DIFFUSERS_DIR.as_posix() if _has_model_index(LOCAL_DIFFUSERS_DIR) else HUB_MODEL_ID),
+        "using": (_PIPELINES.model if _PIPELINES is not None else None),
+        "configured_model": _model_source(cfg)[0],
+        "loading_model": (_SWAP_TARGET[0] if _SWAP_TARGET is not None else None),
+        "last_swap_error": _SWAP_ERROR and {"model": _SWAP_ERROR["model"], "error": _SWAP_ERROR["error"]},
         "local_dir": LOCAL_DIFFUSERS_DIR.as_posix(),
         "local_has_model_index": _has_model_index(LOCAL_DIFFUSERS_DIR),
+        "schedulers": list(SCHEDULERS),
+        "default_scheduler": cfg["sd"]["scheduler"],
+        "queued_jobs": _QUEUE.qsize(),
     })
 
-# ──────────────────────────────────────────────────────────────────────────────    
-# WebSocket /ws/generate
-# Receives: {prompt, steps, guidance, width, height, negative, seed, image?, strength?}
-# Sends:    {"type":"preview"|"final", "image": <base64 png>}
-# Cancels any in-flight generation on new message.
 # ──────────────────────────────────────────────────────────────────────────────
-class SessionState:
-    def __init__(self):
-        self.current_task: Optional[asyncio.Task] = None
-        self.cancel_event = asyncio.Event()
-
-    async def cancel_inflight(self):
-        self.cancel_event.set()
-        if self.current_task and not self.current_task.done():
-            self.current_task.cancel()
-            try:
-                await self.current_task
-            except Exception:
-                pass
-        self.cancel_event.clear()
-        self.current_task = None
-
-async def _send_progress(ws, step: int, total: int):
-    # Clamp & send lightweight progress message
-    step = max(0, min(step, total))
-    await ws.send_text(json.dumps({"type": "progress", "step": step, "total": total}))
-
+# Generation (one job at a time, driven by the job worker)
+# ──────────────────────────────────────────────────────────────────────────────
 def _snap64(x: int) -> int:
     # keep image dims multiples of 64 for SD1.x
     return max(64, int(round(x / 64)) * 64)
 
-async def _generate_and_send(ws, state, prompt: str, cfg: dict):
-    txt2img, img2img = await get_pipeline_pair()
-
-    steps    = int(cfg.get("steps", 24))
-    guidance = float(cfg.get("guidance", 7.0))
-    width    = _snap64(int(cfg.get("width", 512)))
-    height   = _snap64(int(cfg.get("height", 768)))
-    negative = str(cfg.get("negative", "")).strip()
-    seed_val = cfg.get("seed", "") or 123456
+def _pil_to_b64(img: Image.Image) -> str:
+    buf = BytesIO(); img.save(buf, "PNG")
+    return base64.b64encode(buf.getvalue()).decode("ascii")
+
+def _locked_run(ps: PipelineSet, pipe, scheduler: str, size: tuple[int, int], steps: int, fn, profiler=None):
+    """
+    Blocking; runs in the executor. Under the generation lock: swaps in the
+    set's cached scheduler, applies a memory plan for this size and runs `fn()`.
+    `profiler` (a JobProfiler) wraps just that call. Returns (fn(), plan with measured peak).
+    """
+    mem = _cfg()["memory"]
+    with _GEN_LOCK:
+        loads = _SWAP_LOADS
+        ps.schedulers.apply(scheduler, ps.txt2img, ps.img2img)
+        plan = plan_for_pipe(pipe, size[0], size[1], 1, int(steps),
+                             budget_gb=mem.get("budget_gb"), headroom=float(mem.get("headroom", 0.9)),
+                             # a model loading next to this one takes about as much again
+                             reserve_bytes=weights_bytes(pipe) if loads % 2 else 0)
+        apply_plan(pipe, plan)
+        with (profiler or nullcontext()), track_peak(plan):
+            out = fn()
+        swap_overlap = loads % 2 == 1 or _SWAP_LOADS != loads
+    extra = {}
+    if swap_overlap:
+        # the CUDA peak counters are global: they'd include the other model's load
+        plan.measured_peak_bytes = None
+        extra["peak_skipped"] = "model swap loading"
+    record_plan(plan, scheduler=scheduler, **extra)
+    return out, plan
+
+def _run_pipe(ps: PipelineSet, pipe, scheduler: str, size: tuple[int, int], kwargs: dict, on_step, profiler=None):
+    """
+    Pipeline call through `_locked_run`, calling `on_step(step_idx, timestep, latents)`
+    after every denoising step on whichever callback API this diffusers version has.
+    """
+    def _call():
+        if "callback_on_step_end" in pipe.__call__.__code__.co_varnames:
+            def on_step_end(pipe_, step, timestep, cb_kwargs):
+                on_step(step, timestep, cb_kwargs.get("latents")); return cb_kwargs
+            return pipe(**kwargs, callback_on_step_end=on_step_end)
+        def cb(step, timestep, latents):
+            on_step(step, timestep, latents)
+        return pipe(**kwargs, callback=cb, callback_steps=1)
+    return _locked_run(ps, pipe, scheduler, size, kwargs["num_inference_steps"], _call, profiler)
+
+def _params_from(data: dict) -> dict:
+    """Generation knobs shared by WS messages and POST /jobs bodies."""
+    return {
+        "steps": data.get("steps"),
+        "guidance": data.get("guidance"),
+        "width": data.get("width"),
+        "height": data.get("height"),
+        "negative": data.get("negative"),
+        "seed": data.get("seed"),
+        # ⬇️ pass through img2img fields from the client
+        "image": data.get("image"),
+        "strength": data.get("strength"),
+        "scheduler": data.get("scheduler"),
+        "draft": data.get("draft"),
+        "keep_latents": data.get("keep_latents"),
+    }
+
+async def _run_job(job: Job):
+    """Job worker entry: runs `job` on the active pipeline set (a concurrent model swap only affects later jobs)."""
+    ps = await get_pipelines()
+    try:
+        if job.resume is not None:
+            await _resume_and_send(job, ps)
+        else:
+            await _generate_and_send(job, ps)
+    finally:
+        if ps is not _PIPELINES:
+            # last job on a swapped-out model: free its memory now
+            del ps
+            await asyncio.get_running_loop().run_in_executor(None, _release_unused)
+
+async def _generate_and_send(job: Job, ps: PipelineSet):
+    """
+    Run one job on the warm pipeline and publish its events (started/progress/
+    draft/final) to whoever listens: a WebSocket session or SSE/REST clients.
+    Unset knobs fall back to the sd: section of the current config.
+    """
+    txt2img, img2img = ps.txt2img, ps.img2img
+    prompt, cfg = job.prompt, job.params
+    conf = _cfg()
+    sd, draft_cfg = conf["sd"], conf["sd"]["draft"]
+
+    steps    = int(cfg.get("steps") or sd["steps"])
+    guidance = float(cfg.get("guidance") or sd["guidance"])
+    width    = _snap64(int(cfg.get("width") or sd["width"]))
+    height   = _snap64(int(cfg.get("height") or sd["height"]))
+    negative = str(sd["negative"] if cfg.get("negative") is None else cfg["negative"]).strip()
+    seed_val = cfg.get("seed", "") or conf["seed"]
     seed     = int(seed_val)
+    draft    = bool(cfg.get("draft"))
+    profiler = None
+    if cfg.get("profile"):  # only set by admin sessions
+        from anime2d.generate.profiling import JobProfiler
+        profiler = JobProfiler(f"job_{job.id[:12]}")
 
     init_b64 = cfg.get("image") or ""       # <— base64 PNG from client (optional)
-    strength = float(cfg.get("strength", 0.55))  # how much to deviate from the init image (higher = more change)
+    strength = float(cfg.get("strength") or 0.55)  # how much to deviate from the init image (higher = more change)
 
-    await ws.send_text(json.dumps({"type": "started", "total": steps}))
-    gen = torch.Generator(device=("cuda" if torch.cuda.is_available() else "cpu")).manual_seed(seed)
+    try:
+        scheduler = resolve_scheduler_name(cfg.get("scheduler") or sd.get("scheduler"))
+        draft_scheduler = resolve_scheduler_name(draft_cfg.get("scheduler") or scheduler)
+    except ValueError as e:
+        job.publish({"type": "error", "message": str(e)})
+        return
 
     def _check_cancel():
-        if state.cancel_event.is_set():
+        if job.cancel_event.is_set():
             raise RuntimeError("cancelled")
 
     loop = asyncio.get_running_loop()
+    init_img = _b64_to_pil(init_b64) if init_b64 else None
+
+    def _job_args(W: int, H: int, n_steps: int) -> tuple:
+        """(pipe, kwargs) for one pass at the given size/steps."""
+        kw = dict(
+            prompt=prompt,
+            negative_prompt=negative,
+            num_inference_steps=n_steps,
+            guidance_scale=guidance,
+            # same seed for draft and full pass
+            generator=torch.Generator(device=_device()).manual_seed(seed),
+        )
+        if init_img is not None:
+            # ---------- IMG2IMG ----------
+            kw.update(image=init_img.resize((W, H), Image.BICUBIC),  # SD1.x wants multiples of 64
+                      strength=strength)                               # <— key knob for “how much to change”
+            return img2img, kw
+        # ---------- TXT2IMG ----------
+        kw.update(height=H, width=W)
+        return txt2img, kw
+
+    def _meta(W: int, H: int, n_steps: int, sched: str) -> dict:
+        return {
+            "mode": ("img2img" if init_b64 else "txt2img"),
+            "steps": n_steps, "guidance": guidance,
+            "width": W, "height": H,
+            "seed": seed, "negative": negative,
+            "strength": strength if init_b64 else None,
+            "scheduler": sched,
+            "model": ps.model,
+        }
 
-    # Progress callback (new API if available)
-    def _progress_emit(step_idx: int):
-        asyncio.run_coroutine_threadsafe(_send_progress(ws, min(step_idx + 1, steps), steps), loop)
+    if job.latent_store is not None:
+        # the store describes the session's latest job only: continue/branch must
+        # never pick up an older one after a job that kept nothing (or was cancelled)
+        job.latent_store.clear()
 
     try:
-        if init_b64:
-            # ---------- IMG2IMG ----------
-            init_img = _b64_to_pil(init_b64)
-            init_img = init_img.resize((width, height), Image.BICUBIC)  # SD1.x wants multiples of 64
-
-            if "callback_on_step_end" in img2img.__call__.__code__.co_varnames:
-                def on_step_end(pipe_, step, timestep, cb_kwargs):
-                    _check_cancel()
-                    _progress_emit(step)
-                    return cb_kwargs
-                result = await loop.run_in_executor(
-                    None,
-                    lambda: img2img(
-                        prompt=prompt,
-                        image=init_img,
-                        strength=strength,                 # <— key knob for “how much to change”
-                        negative_prompt=negative,
-                        num_inference_steps=steps,
-                        guidance_scale=guidance,
-                        generator=gen,
-                        callback_on_step_end=on_step_end,
-                    )
-                )
-            else:
-                def cb(step, timestep, latents):
-                    _check_cancel()
-                    _progress_emit(step)
-                result = await loop.run_in_executor(
-                    None,
-                    lambda: img2img(
-                        prompt=prompt,
-                        image=init_img,
-                        strength=strength,
-                        negative_prompt=negative,
-                        num_inference_steps=steps,
-                        guidance_scale=guidance,
-                        generator=gen,
-                        callback=cb,
-                        callback_steps=1,
-                    )
-                )
-        else:
-            # ---------- TXT2IMG ----------
-            if "callback_on_step_end" in txt2img.__call__.__code__.co_varnames:
-                def on_step_end(pipe_, step, timestep, cb_kwargs):
-                    _check_cancel(); _progress_emit(step); return cb_kwargs
-                result = await loop.run_in_executor(
-                    None,
-                    lambda: txt2img(
-                        prompt=prompt,
-                        negative_prompt=negative,
-                        height=height, width=width,
-                        num_inference_steps=steps,
-                        guidance_scale=guidance,
-                        generator=gen,
-                        callback_on_step_end=on_step_end,
-                    )
-                )
-            else:
-                def cb(step, timestep, latents):
-                    _check_cancel(); _progress_emit(step)
-                result = await loop.run_in_executor(
-                    None,
-                    lambda: txt2img(
-                        prompt=prompt,
-                        negative_prompt=negative,
-                        height=height, width=width,
-                        num_inference_steps=steps,
-                        guidance_scale=guidance,
-                        generator=gen,
-                        callback=cb, callback_steps=1,
-                    )
-                )
-    except asyncio.CancelledError:
-        return
+        # running from here on: REST/SSE clients see the job leave `queued` before the draft
+        job.publish({"type": "started", "total": steps})
+
+        if draft:
+            # ---------- DRAFT (no progress events; it is over in a blink) ----------
+            scale = float(draft_cfg.get("scale") or 0.5)
+            dW, dH = _snap64(width * scale), _snap64(height * scale)
+            d_steps = min(int(draft_cfg.get("steps") or 8), steps)
+            pipe, kw = _job_args(dW, dH, d_steps)
+            result, _ = await loop.run_in_executor(
+                None, lambda: _run_pipe(ps, pipe, draft_scheduler, (dW, dH), kw,
+                                        lambda i, t, lat: _check_cancel())
+            )
+            job.publish({
+                "type": "draft",
+                "image": _pil_to_b64(result.images[0]),
+                "meta": _meta(dW, dH, d_steps, draft_scheduler),
+            })
+            _check_cancel()
+
+        # Optional latent checkpoints for continue/branch (WS sessions only)
+        ckpts = None
+        if cfg.get("keep_latents") and job.latent_store is not None:
+            ckpts = job.latent_store.begin(
+                {**_meta(width, height, steps, scheduler), "prompt": prompt}, steps, width, height)
+
+        # Progress callback (diffusion thread → loop)
+        def _on_step(step_idx: int, timestep, latents):
+            _check_cancel()
+            if ckpts is not None and latents is not None:
+                ckpts.record(step_idx, timestep, latents)
+            step = max(0, min(step_idx + 1, steps))
+            loop.call_soon_threadsafe(job.publish, {"type": "progress", "step": step, "total": steps})
+
+        pipe, kw = _job_args(width, height, steps)
+        result, plan = await loop.run_in_executor(
+            None, lambda: _run_pipe(ps, pipe, scheduler, (width, height), kw, _on_step, profiler)
+        )
     except RuntimeError as e:
-        if "cancelled" in str(e): return
+        if "cancelled" in str(e):
+            job.publish({"type": "cancelled"})
+            return
         raise
 
-    img = result.images[0]
-    buf = BytesIO(); img.save(buf, "PNG")
-    b64 = base64.b64encode(buf.getvalue()).decode("ascii")
-    await ws.send_text(json.dumps({
+    meta = _meta(width, height, steps, scheduler)
+    meta["draft"] = draft
+    meta["memory"] = plan.to_dict()
+    meta["latents_kept"] = ckpts is not None
+    if profiler is not None and profiler.trace_path is not None:
+        # links need ?token=<admin token> appended by the client
+        base = f"/profiles/{profiler.out_dir.parent.name}"
+        job.publish({
+            "type": "profile",
+            "trace": f"{base}/{profiler.trace_path.name}",
+            "stacks": f"{base}/{profiler.stacks_path.name}",
+            "ops": f"{base}/{profiler.ops_path.name}",
+            "wall_s": profiler.wall_s,
+        })
+    job.publish({
         "type": "final",
-        "image": b64,
-        "meta": {
-            "mode": ("img2img" if init_b64 else "txt2img"),
-            "steps": steps, "guidance": guidance,
-            "width": width, "height": height,
-            "seed": seed, "negative": negative,
-            "strength": strength if init_b64 else None,
-        }
-    }))
+        "image": _pil_to_b64(result.images[0]),
+        "meta": meta,
+    })
+
+async def _resume_and_send(job: Job, ps: PipelineSet):
+    """
+    `continue` / `branch` jobs: pick up the session's last checkpointed job
+    part-way through instead of denoising again from step 0.
+
+    branch   — same schedule; from step `from_step` on, use the new prompt/
+               negative/guidance.
+    continue — re-denoise the tail from `from_step` on a finer schedule of
+               `steps` total steps (more steps where detail is decided).
+    """
+    from anime2d.generate.checkpoints import resume_denoise, resume_schedule
+
+    r = job.resume
+    parent = r["parent"]
+    p = parent.params
+    kind = r["kind"]
+    if p.get("model") != ps.model:
+        # kept latents only mean something to the model that made them
+        job.publish({"type": "error", "message": f"the server switched to {ps.model}; generate again before continue/branch"})
+        return
+    try:
+        from_step = int(r.get("from_step") or (parent.steps_done * 2 // 3 if kind == "branch" else parent.steps_done // 2))
+        resume_i, latents = parent.resume_point(from_step)
+    except ValueError as e:
+        job.publish({"type": "error", "message": str(e)})
+        return
+
+    prompt = job.prompt or p["prompt"]
+    negative = p["negative"] if r.get("negative") is None else str(r["negative"]).strip()
+    guidance = p["guidance"] if r.get("guidance") is None else float(r["guidance"])
+    # steps between the stored checkpoint and `from_step` are redone with the old conditioning
+    replay = from_step - (resume_i + 1)
+    if kind == "continue":
+        total = int(r.get("steps") or int(p["steps"]) * 2)
+        if total <= int(p["steps"]):
+            job.publish({"type": "error", "message": f"continue needs steps > {p['steps']}"})
+            return
+        segments = [(0, p["prompt"], p["negative"], p["guidance"])]
+    else:
+        total = int(p["steps"])
+        segments = [(replay, p["prompt"], p["negative"], p["guidance"]), (0, prompt, negative, guidance)]
+
+    start_t = parent.timesteps[resume_i + 1]
+    width, height = int(p["width"]), int(p["height"])
+    meta = {**p, "prompt": prompt, "negative": negative, "guidance": guidance,
+            "mode": kind, "steps": total, "from_step": from_step, "reused_steps": resume_i + 1}
+
+    child = None
+    if job.latent_store is not None:
+        # stride for the new length, so a longer `continue` stays within the store's budget
+        child = parent.prefix(resume_i, {**meta, "mode": p["mode"]},
+                              stride=job.latent_store.stride_for(total, width, height))
+
+    def _check_cancel():
+        if job.cancel_event.is_set():
+            raise RuntimeError("cancelled")
+
+    loop = asyncio.get_running_loop()
+    remaining = {"n": 0}
+
+    def _on_step(step_idx: int, timestep, lat):
+        _check_cancel()
+        if child is not None:
+            child.record(step_idx, timestep, lat)
+        done = step_idx + 1 - (resume_i + 1)
+        loop.call_soon_threadsafe(job.publish, {"type": "progress", "step": done, "total": remaining["n"]})
+
+    # remaining step count on the same tail resume_denoise runs, for progress totals
+    # (on a throwaway scheduler: the cached one may be mid-run for another job)
+    remaining["n"] = len(resume_schedule(ps.schedulers.build(p["scheduler"]), total, start_t))
+    job.publish({"type": "started", "total": remaining["n"]})
+
+    gen = torch.Generator(device=_device()).manual_seed(int(p["seed"]) + from_step)
+    try:
+        image, plan = await loop.run_in_executor(None, lambda: _locked_run(
+            ps, ps.txt2img, p["scheduler"], (width, height), total,
+            lambda: resume_denoise(
+                ps.txt2img, latents,
+                num_inference_steps=total, start_timestep=start_t, segments=segments,
+                generator=gen, first_step=resume_i + 1, on_step=_on_step,
+            ),
+        ))
+    except RuntimeError as e:
+        if "cancelled" in str(e):
+            job.publish({"type": "cancelled"})
+            return
+        raise
+
+    if child is not None:
+        job.latent_store.keep(child)
+    meta["memory"] = plan.to_dict()
+    meta["latents_kept"] = child is not None
+    job.publish({"type": "final", "image": _pil_to_b64(image), "meta": meta})
+
+_QUEUE = JobQueue(_run_job)
+_JOBS = JobStore(ttl_s=float(_cfg()["server"]["job_ttl_s"]))
+
+# ──────────────────────────────────────────────────────────────────────────────
+# WebSocket /ws/generate
+# Receives: {prompt, steps, guidance, width, height, negative, seed, image?, strength?,
+#            scheduler?, draft?, profile?, keep_latents?}
+#           {"type":"continue", steps?, from_step?}
+#           {"type":"branch", from_step?, prompt?, negative?, guidance?}
+# Sends:    {"type":"started"|"progress"|"draft"|"profile"|"final"|"error", ...}
+# continue/branch reuse the latents kept (keep_latents: true) for the session's last job.
+# `profile: true` needs an admin session: connect with ?token=<server.admin_token>.
+# Cancels any in-flight generation on new message. Jobs go through the shared
+# queue at interactive priority, ahead of REST batch work.
+# ──────────────────────────────────────────────────────────────────────────────
+class SessionState:
+    def __init__(self):
+        self.job: Optional[Job] = None
+        self.current_task: Optional[asyncio.Task] = None  # forwards job events to the socket
+        # checkpoints of the most recent job; budget re-read per job so config edits apply live
+        self.latents = LatentStore(lambda: int(float(_cfg()["server"]["latent_store_mb"]) * 1024 * 1024))
+
+    async def cancel_inflight(self):
+        if self.job is not None:
+            self.job.cancel()
+        if self.current_task and not self.current_task.done():
+            self.current_task.cancel()
+            try:
+                await self.current_task
+            except BaseException:
+                pass
+        self.job = None
+        self.current_task = None
+
+async def _forward_events(ws, job: Job):
+    q = job.subscribe()
+    try:
+        while True:
+            ev = await q.get()
+            if ev["type"] == "cancelled":
+                return  # the cancel handler answers the client itself
+            await ws.send_text(json.dumps(ev))
+            if ev["type"] in TERMINAL_EVENTS:
+                return
+    finally:
+        job.unsubscribe(q)
 
 @app.websocket("/ws/generate")
 async def ws_generate(ws: WebSocket):
     await ws.accept()
+    is_admin = _is_admin(ws.query_params.get("token"))
     state = SessionState()
     await ws.send_text(json.dumps({"type": "ready"}))
     try:
@@ -249,28 +600,160 @@ async def ws_generate(ws: WebSocket):
                 await ws.send_text(json.dumps({"type": "cancelled"}))
                 continue
 
+            # Resume the last checkpointed job part-way
+            if data.get("type") in ("continue", "branch"):
+                await state.cancel_inflight()
+                parent = state.latents.latest
+                if parent is None:
+                    await ws.send_text(json.dumps({"type": "error", "message": "no kept latents; send keep_latents: true first"}))
+                    continue
+                state.job = Job(str(data.get("prompt") or "").strip(), {"steps": data.get("steps")})
+                state.job.latent_store = state.latents
+                state.job.resume = {
+                    "kind": data["type"], "parent": parent,
+                    "from_step": data.get("from_step"), "steps": data.get("steps"),
+                    "negative": data.get("negative"), "guidance": data.get("guidance"),
+                }
+                state.current_task = asyncio.create_task(_forward_events(ws, state.job))
+                _QUEUE.submit(state.job, priority=PRIORITY_INTERACTIVE)
+                continue
+
             # Generate
             prompt = str(data.get("prompt", "")).strip()
-            cfg = {
-                "steps": data.get("steps"),
-                "guidance": data.get("guidance"),
-                "width": data.get("width"),
-                "height": data.get("height"),
-                "negative": data.get("negative"),
-                "seed": data.get("seed"),
-                # ⬇️ pass through img2img fields from the client
-                "image": data.get("image"),
-                "strength": data.get("strength"),
-            }
-
+            cfg = _params_from(data)
+            if data.get("profile"):
+                if not is_admin:
+                    await ws.send_text(json.dumps({"type": "error", "message": "profiling is admin-only"}))
+                    continue
+                cfg["profile"] = True
 
             await state.cancel_inflight()
             if not prompt:
                 continue
 
-            state.current_task = asyncio.create_task(_generate_and_send(ws, state, prompt, cfg))
+            state.job = Job(prompt, cfg)
+            state.job.latent_store = state.latents
+            state.current_task = asyncio.create_task(_forward_events(ws, state.job))
+            _QUEUE.submit(state.job, priority=PRIORITY_INTERACTIVE)
     except WebSocketDisconnect:
         await state.cancel_inflight()
     except Exception:
         await state.cancel_inflight()
-        raise
\ No newline at end of file
+        raise
+
+# ──────────────────────────────────────────────────────────────────────────────
+# REST jobs (batch / HTTP-only clients); same queue and worker as the WebSocket
+# POST   /jobs                {prompt | prompts: [...], <same knobs as WS>}
+# GET    /jobs/{id}           status, progress, meta, base64 image when done
+# GET    /jobs/{id}/image     PNG bytes
+# GET    /jobs/{id}/events    text/event-stream of started/progress/draft/final/...
+# DELETE /jobs/{id}           cancel (if pending) and forget
+# Finished jobs are kept for server.job_ttl_s seconds.
+# ──────────────────────────────────────────────────────────────────────────────
+class JobRequest(BaseModel):
+    prompt: Optional[str] = None
+    prompts: Optional[list[str]] = None
+    steps: Optional[int] = None
+    guidance: Optional[float] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    negative: Optional[str] = None
+    seed: Optional[Union[int, str]] = None
+    image: Optional[str] = None
+    strength: Optional[float] = None
+    scheduler: Optional[str] = None
+    draft: Optional[bool] = None
+
+def _job_or_404(job_id: str) -> Job:
+    job = _JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="unknown or expired job id")
+    return job
+
+@app.post("/jobs", status_code=202)
+async def create_jobs(req: JobRequest):
+    body = req.model_dump() if hasattr(req, "model_dump") else req.dict()
+    prompts = [p.strip() for p in (req.prompts or ([req.prompt] if req.prompt else [])) if p and p.strip()]
+    if not prompts:
+        raise HTTPException(status_code=422, detail="give `prompt` or a non-empty `prompts` list")
+    if req.scheduler:
+        try:
+            resolve_scheduler_name(req.scheduler)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+    max_pending = int(_cfg()["server"]["max_pending_jobs"])
+    if _JOBS.pending() + len(prompts) > max_pending:
+        raise HTTPException(status_code=429, detail=f"too many pending jobs (limit {max_pending})")
+
+    params = _params_from(body)
+    jobs = []
+    for prompt in prompts:
+        job = Job(prompt, dict(params))
+        job.image_dir = dated_output_dir() / "jobs"   # results go to disk, not the heap
+        job.image_url = f"/jobs/{job.id}/image"
+        _JOBS.add(job)
+        _QUEUE.submit(job, priority=PRIORITY_BATCH)
+        jobs.append({"id": job.id, "status": job.status,
+                     "url": f"/jobs/{job.id}", "events": f"/jobs/{job.id}/events"})
+    return {"jobs": jobs, "queued": _QUEUE.qsize()}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, include_image: bool = True):
+    return _job_or_404(job_id).to_dict(include_images=include_image)
+
+@app.get("/jobs/{job_id}/image")
+async def get_job_image(job_id: str, draft: bool = False):
+    job = _job_or_404(job_id)
+    saved = job.draft if draft else job.result
+    if saved is None:
+        raise HTTPException(status_code=409, detail=f"job is {job.status}" + (" (no draft)" if draft else ""))
+    if not saved.get("path") or not Path(saved["path"]).exists():
+        raise HTTPException(status_code=410, detail="image file is gone")
+    return FileResponse(saved["path"], media_type="image/png")
+
+@app.delete("/jobs/{job_id}")
+async def delete_job(job_id: str):
+    job = _job_or_404(job_id)
+    job.cancel()
+    _JOBS.pop(job_id)
+    return {"id": job.id, "status": job.status if job.done else "cancelling"}
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    job = _job_or_404(job_id)
+
+    async def _stream():
+        q = job.subscribe()
+        try:
+            while True:
+                try:
+                    ev = await asyncio.wait_for(q.get(), timeout=SSE_KEEPALIVE_S)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"  # keeps idle proxies from closing the stream
+                    continue
+                yield f"event: {ev['type']}\ndata: {json.dumps(ev)}\n\n"
+                if ev["type"] in TERMINAL_EVENTS:
+                    return
+        finally:
+            job.unsubscribe(q)
+
+    return StreamingResponse(_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Profile downloads (admin): /profiles/<date>/<file>?token=...
+# ──────────────────────────────────────────────────────────────────────────────
+_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+_PROFILE_FILE_RE = re.compile(r"^[\w-]+\.(trace\.json|folded\.txt|ops\.txt)$")
+
+@app.get("/profiles/{date}/{name}")
+async def get_profile(date: str, name: str, token: Optional[str] = None):
+    if not _is_admin(token):
+        raise HTTPException(status_code=403, detail="admin token required")
+    if not _DATE_RE.match(date) or not _PROFILE_FILE_RE.match(name):
+        raise HTTPException(status_code=404, detail="not found")
+    from anime2d.generate.profiling import profiles_dir
+    path = profiles_dir(date) / name
+    if not path.exists():
+        raise HTTPException(status_code=404, detail="not found")
+    return FileResponse(path, filename=name)